@@ -0,0 +1,241 @@
+# Logging for the AVB server and the Lambda client, built on the standard
+# logging module. Records are written one per line, either as text:
+#
+#   2016-07-10 12:00:00.123 INFO server: handled message action=get status=0 ms=1.42
+#
+# or as JSON (easier to filter in CloudWatch):
+#
+#   {"ts": 1468152000.123, "level": "info", "logger": "server", "msg": "handled message", "action": "get", ...}
+#
+# Values that describe an event (ids, timings, status codes) are passed as
+# fields rather than being formatted into the message, e.g.
+#
+#   log.info('handled message', extra=avblog.kv(action='get', ms=1.42))
+#
+# so they can be searched for and aggregated.
+#
+# Writing to stdout can block (a slow terminal, a full pipe to the service
+# manager) so the server queues the records and a background thread writes
+# them out. If the queue fills up records are dropped (and counted) rather
+# than holding up a client. The message payloads are only logged at debug
+# level, and then only for a sample of the messages (payload_sample).
+import sys
+import atexit
+import json
+import time
+import random
+import threading
+import Queue
+import logging
+
+LEVELS = {'debug': logging.DEBUG,
+          'info': logging.INFO,
+          'warning': logging.WARNING,
+          'error': logging.ERROR}
+
+FORMATS = ('text', 'json')
+
+# Parent of all our loggers. Nothing is written until setup() is called.
+root = logging.getLogger('avb')
+root.addHandler(logging.NullHandler())
+root.propagate = False
+
+# Fraction of the messages whose payload is logged (at debug level)
+payload_sample = 1.0
+
+# The queue handler installed by setup() (None when logging synchronously)
+queue_handler = None
+
+# Return the logger for a part of the code (e.g. "server")
+def get_logger(name):
+    return logging.getLogger('avb.' + name)
+
+# Build the extra argument of a logging call from the fields of the event
+def kv(**fields):
+    return {'fields': fields}
+
+# True if a message payload should be logged. Call this before building the
+# dump so the work is skipped for the messages that aren't logged.
+def want_payload(log):
+    if not log.isEnabledFor(logging.DEBUG):
+        return False
+    return payload_sample >= 1.0 or random.random() < payload_sample
+
+# The traceback of a record, if it has one. Records that went through the
+# queue only have the text.
+def exc_text(formatter, record):
+    if record.exc_info:
+        return formatter.formatException(record.exc_info)
+    return record.exc_text
+
+def format_value(value):
+    if isinstance(value, float):
+        return '{:.3f}'.format(value).rstrip('0').rstrip('.')
+    value = str(value)
+    if ' ' in value or '"' in value or value == '':
+        return json.dumps(value)
+    return value
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = '{:s}.{:03d} {:s} {:s}: {:s}'.format(
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record.created)),
+            int(record.msecs), record.levelname, record.name[4:], record.getMessage())
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' ' + ' '.join('{:s}={:s}'.format(k, format_value(v))
+                                   for (k, v) in sorted(fields.items()))
+        exc = exc_text(self, record)
+        if exc:
+            line += '\n' + exc
+        return line
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        d = {'ts': round(record.created, 3),
+             'level': record.levelname.lower(),
+             'logger': record.name[4:],
+             'msg': record.getMessage()}
+        fields = getattr(record, 'fields', None)
+        if fields:
+            d.update(fields)
+        exc = exc_text(self, record)
+        if exc:
+            d['exc'] = exc
+        return json.dumps(d, default=str)
+
+class StdoutHandler(logging.Handler):
+    """
+    Writes to whatever sys.stdout is when the record is emitted, so tools
+    that swap out stdout (e.g. to silence the client) still work.
+    """
+    def emit(self, record):
+        try:
+            sys.stdout.write(self.format(record) + '\n')
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        try:
+            sys.stdout.flush()
+        except Exception:
+            pass
+
+class QueueHandler(logging.Handler):
+    """
+    Hands records to a background thread that passes them to target. The
+    caller only pays for formatting the message string, never for the write.
+    When more than queue_size records are waiting new ones are dropped.
+    """
+    def __init__(self, target, queue_size):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue = Queue.Queue(queue_size)
+        # Records dropped since the last warning (the handler's own lock is
+        # held while emit() runs, so this needs its own)
+        self.dropped_lock = threading.Lock()
+        self.dropped = 0
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+    def emit(self, record):
+        # Render the message now, the arguments may change once we return
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = self.target.formatter.formatException(record.exc_info)
+                record.exc_info = None
+        except Exception:
+            self.handleError(record)
+            return
+
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            try:
+                with self.dropped_lock:
+                    dropped = self.dropped
+                    self.dropped = 0
+                if dropped > 0:
+                    self.target.handle(logging.makeLogRecord(
+                        {'name': 'avb.log', 'levelname': 'WARNING', 'levelno': logging.WARNING,
+                         'msg': 'log queue full, dropped records', 'fields': {'dropped': dropped}}))
+                self.target.handle(record)
+                # Write out whatever has built up once we catch up
+                if self.queue.empty():
+                    self.target.flush()
+            finally:
+                self.queue.task_done()
+
+    # Wait until everything queued so far has been written
+    def drain(self):
+        self.queue.join()
+
+# Configure the logging for the process. Can be called again (e.g. when the
+# configuration is reloaded).
+#
+# level: one of LEVELS
+# fmt: "text" or "json"
+# sample: fraction (0-1) of the message payloads that are logged at debug level
+# queue_size: records that may wait to be written by the background thread, 0
+#   to write them synchronously
+def setup(level='info', fmt='text', sample=1.0, queue_size=10000):
+    global payload_sample, queue_handler
+
+    if level not in LEVELS:
+        raise ValueError('invalid log level "' + level + '"')
+    if fmt not in FORMATS:
+        raise ValueError('invalid log format "' + fmt + '"')
+
+    flush()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+
+    handler = StdoutHandler()
+    if fmt == 'json':
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(TextFormatter())
+
+    if queue_size > 0:
+        queue_handler = QueueHandler(handler, queue_size)
+        root.addHandler(queue_handler)
+    else:
+        queue_handler = None
+        root.addHandler(handler)
+    root.setLevel(LEVELS[level])
+    payload_sample = max(0.0, min(1.0, sample))
+
+# Read the [log] section of a configuration file and call setup(). Options that
+# aren't given keep the defaults passed in. Raises ValueError if an option is
+# invalid.
+def setup_from_config(cfg, level='info', fmt='text', sample=1.0, queue_size=10000):
+    if cfg.has_section('log'):
+        if cfg.has_option('log', 'level'):
+            level = cfg.get('log', 'level')
+        if cfg.has_option('log', 'format'):
+            fmt = cfg.get('log', 'format')
+        if cfg.has_option('log', 'payload_sample'):
+            sample = cfg.getfloat('log', 'payload_sample')
+        if cfg.has_option('log', 'queue_size'):
+            queue_size = cfg.getint('log', 'queue_size')
+    setup(level, fmt, sample, queue_size)
+
+# Wait for any queued records to be written
+def flush():
+    if queue_handler is not None:
+        queue_handler.drain()
+    for h in root.handlers:
+        h.flush()
+
+# Don't lose what is still queued when the process exits (e.g. sys.exit()
+# after logging a configuration error)
+atexit.register(flush)
@@ -3,67 +3,190 @@
 # to server (e.g. code running on local network). The server is responsible
 # for taking a message and turning it into a command to issue to
 # Vera through the UpnP interface.
+import os
 import json
 import base64
+import struct
 # FIXME - should probably make these conditional imports
 from Crypto.Cipher import AES
-from Crypto import Random
+
+# ChaCha20-Poly1305 needs PyCryptodome, it isn't in the original PyCrypto
+try:
+    from Crypto.Cipher import ChaCha20_Poly1305
+except ImportError:
+    ChaCha20_Poly1305 = None
+
+# MessagePack is optional, it is only needed for the FMT_MSGPACK body format
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# err_str of the response to a message in a protocol version the other end
+# doesn't speak (see version_error())
+VERSION_ERROR = 'unsupported protocol version'
+
+# err_str of the response to a message whose body format the other end can't
+# read. The data of the response lists the formats it can (AVBMessage.FORMATS).
+FORMAT_ERROR = 'unsupported body format'
+
+class UnsupportedVersion(ValueError):
+    """
+    Raised when a message header has a protocol version we don't speak. The
+    other end is probably newer than us, see version_error().
+    """
+    pass
 
 class AVBMessage:
     # Constants
     HEADER_SIZE = 8
+    HEADER_SIZE_V2 = 16
     LENGTH_FIELD_SIZE = 4
     VERSION_FIELD_SIZE = 2
     ENCODING_FIELD_SIZE = 2
+    ID_FIELD_SIZE = 8
     PSK_256_SIZE = 44 # bytes for 256 bit PSK encoded in base64
     IV_SIZE = 24 # bytes for 16 byte IV encoded in base64
-    MAX_MESSAGE_SIZE = 9999
+    RAW_IV_SIZE = 16 # bytes for the IV in a version 3 message
+    NONCE_SIZE = 12 # bytes for the ChaCha20-Poly1305 nonce
+    TAG_SIZE = 16 # bytes for the Poly1305 authentication tag
+    MAX_MESSAGE_SIZE = 9999 # limited by the 4 digit length field
+    # Version 3 has a 32 bit length field. We don't want a bad header to make
+    # the other end buffer gigabytes, so the limit is lower than that, but
+    # it's still big enough for the full device and scene listing.
+    MAX_MESSAGE_SIZE_V3 = 4 * 1024 * 1024
+    MAX_ID = 99999999
+
+    # Version 3 messages use a binary header:
+    #   magic (1 byte), version (1), encoding (1), body format (1),
+    #   length (4, network order), request id (4)
+    # The magic byte can't be an ASCII digit so a version 3 message can be
+    # told apart from version 1/2 from its first byte. The length is in the
+    # first HEADER_SIZE bytes just like the older versions.
+    MAGIC = 0xAB
+    HEADER_V3 = struct.Struct('!BBBBII')
 
     # Message version enums
+    # Version 2 adds a request id to the header. The server copies the id into
+    # the response, so a client can have several requests in flight on one
+    # connection and match up the responses (which may come back in any order).
+    # Version 3 keeps the request id but uses a binary header and sends the IV
+    # and ciphertext as raw bytes instead of base64.
     VER_1 = 1
+    VER_2 = 2
+    VER_3 = 3
+    VERSIONS = (VER_1, VER_2, VER_3)
 
     # Encoding enums
+    # ENC_CHACHA20_POLY1305 is an authenticated encryption mode, so a message
+    # that has been tampered with (or encrypted with a different key) fails to
+    # decode. It needs no padding and is several times faster than AES on a
+    # CPU without AES instructions (like the Raspberry Pi). It is only
+    # supported for version 3 messages since the body is binary.
     ENC_PLAIN = 1
     ENC_AES_CBC = 2
+    ENC_CHACHA20_POLY1305 = 3
+    HAVE_CHACHA20_POLY1305 = ChaCha20_Poly1305 is not None
+
+    # Body format enums (version 3 only, older versions are always JSON)
+    FMT_JSON = 1
+    FMT_MSGPACK = 2
+    HAVE_MSGPACK = msgpack is not None
+    # The body formats we can read
+    FORMATS = (FMT_JSON, FMT_MSGPACK) if HAVE_MSGPACK else (FMT_JSON,)
 
-    def __init__(self, version=None, encoding=None, psk=None, data=None):
+    def __init__(self, version=None, encoding=None, psk=None, data=None, fmt=None):
         # Fill in the header, defaults are version 1, plaintext encoding
         self.length = 8
         self.version = 1
         self.encoding = 1
+        self.fmt = AVBMessage.FMT_JSON
+        self.msg_id = 0
         self.data = ''
-        self.psk = ''
+        self.codec = None
         self.iv = ''
-        if data is not None:
-            self.set_data(data)
         if version is not None:
             # Check that version is valid
-            if version != AVBMessage.VER_1:
+            if version not in (AVBMessage.VER_1, AVBMessage.VER_2, AVBMessage.VER_3):
                 raise ValueError('Unsupported version type')
             self.version = version
+            self.length = self.header_size()
         if encoding is not None:
             # Check that encoding is a valid type
-            if encoding != AVBMessage.ENC_PLAIN and encoding != AVBMessage.ENC_AES_CBC:
-                raise ValueError('Unsupported encoding type')
+            self.check_encoding(encoding)
             self.encoding = encoding
+        if fmt is not None:
+            # Check that the body format is valid for the version
+            if fmt != AVBMessage.FMT_JSON and fmt != AVBMessage.FMT_MSGPACK:
+                raise ValueError('Unsupported format type')
+            if fmt != AVBMessage.FMT_JSON and self.version != AVBMessage.VER_3:
+                raise ValueError('Format only supported for VER_3')
+            if fmt == AVBMessage.FMT_MSGPACK and msgpack is None:
+                raise ValueError('msgpack module is not installed')
+            self.fmt = fmt
         if psk is not None:
             self.set_psk(psk)
+        if data is not None:
+            self.set_data(data)
+
+    # Raise an error if the encoding can't be used with the message version
+    def check_encoding(self, encoding):
+        if encoding == AVBMessage.ENC_PLAIN or encoding == AVBMessage.ENC_AES_CBC:
+            return
+        if encoding != AVBMessage.ENC_CHACHA20_POLY1305:
+            raise ValueError('Unsupported encoding type')
+        if self.version != AVBMessage.VER_3:
+            raise ValueError('Encoding only supported for VER_3')
+        if ChaCha20_Poly1305 is None:
+            raise ValueError('ChaCha20-Poly1305 needs PyCryptodome')
 
-    # This function takes a base64 encoded key as a string
+    # This function takes a base64 encoded key as a string (or an AVBCodec
+    # made from one)
     def set_psk(self, psk):
         # The key size allowed depends on the encryption being used.
         if self.encoding == AVBMessage.ENC_PLAIN:
             # No PSK for plaintext encoding, raise error
             raise ValueError('PSK not supported for ENC_PLAIN')
-        elif self.encoding == AVBMessage.ENC_AES_CBC:
-            # Key must be 16/24/32 bytes long (for our case, enforce 32 bytes)
-            if len(psk) != AVBMessage.PSK_256_SIZE:
-                raise ValueError('Bad PSK length')
-            self.psk = psk
-        
+        if isinstance(psk, AVBCodec):
+            self.codec = psk
+        else:
+            self.codec = AVBCodec.get(psk)
+
     # Return the currently set PSK as a base64 encoded string
     def get_psk(self):
-        return self.psk
+        if self.codec is None:
+            return ''
+        return self.codec.psk
+
+    # Set the request id (version 2 and later messages only)
+    def set_id(self, msg_id):
+        if self.version == AVBMessage.VER_1:
+            raise ValueError('Request id not supported for VER_1')
+        if msg_id < 0 or msg_id > AVBMessage.MAX_ID:
+            raise ValueError('Bad request id')
+        self.msg_id = msg_id
+
+    # Return the request id (always 0 for version 1 messages)
+    def get_id(self):
+        return self.msg_id
+
+    # Returns True if the message version carries a request id
+    def has_id(self):
+        return self.version != AVBMessage.VER_1
+
+    # Returns the size of the header for the message version
+    def header_size(self):
+        if self.version == AVBMessage.VER_3:
+            return AVBMessage.HEADER_V3.size
+        if self.version == AVBMessage.VER_2:
+            return AVBMessage.HEADER_SIZE_V2
+        return AVBMessage.HEADER_SIZE
+
+    # Returns the largest message allowed for the message version
+    def max_size(self):
+        if self.version == AVBMessage.VER_3:
+            return AVBMessage.MAX_MESSAGE_SIZE_V3
+        return AVBMessage.MAX_MESSAGE_SIZE
 
     # This function takes a dictionary object (data) and converts it to a JSON
     # string that is stored as the message body
@@ -71,29 +194,25 @@ class AVBMessage:
         if type(data) != dict:
             raise ValueError('Message data type should be dict')
 
-        # Turn to JSON string
+        # Turn to JSON string (or MessagePack)
         try:
-            self.data = json.dumps(data)
+            if self.fmt == AVBMessage.FMT_MSGPACK:
+                self.data = msgpack.packb(data)
+            else:
+                self.data = json.dumps(data)
         except:
             data = None
         self.iv = ''
 
-        # Generate random IV and encrypt using PSK
-        if self.encoding == AVBMessage.ENC_AES_CBC:
-            r = Random.new()
-            iv = r.read(AES.block_size)
-            key = base64.b64decode(self.psk)
-            enc_cipher = AES.new(key, AES.MODE_CBC, iv)
-            pad = '*' * (AES.block_size - (len(self.data) % AES.block_size))
-            enc = enc_cipher.encrypt(self.data + pad)
-
-            # Replace with IV + encrypted string
-            self.iv = base64.b64encode(iv)
-            self.data = base64.b64encode(enc)
+        # Encrypt using PSK
+        if self.encoding != AVBMessage.ENC_PLAIN:
+            if self.codec is None:
+                raise ValueError('No PSK set')
+            (self.iv, self.data) = self.codec.encrypt(self.encoding, self.version, self.data)
 
         # Update the header
-        self.length = AVBMessage.HEADER_SIZE + len(self.iv) + len(self.data)
-        if self.length > AVBMessage.MAX_MESSAGE_SIZE:
+        self.length = self.header_size() + len(self.iv) + len(self.data)
+        if self.length > self.max_size():
             raise ValueError('Message is too long')
 
     # This function returns the message contents as a dictionary
@@ -103,14 +222,16 @@ class AVBMessage:
         data = self.data
 
         # Decrypt if needed
-        if self.encoding == AVBMessage.ENC_AES_CBC:
-            key = base64.b64decode(self.psk)
-            iv = base64.b64decode(self.iv)
-            dec_cipher = AES.new(key, AES.MODE_CBC, iv)
-            dec = dec_cipher.decrypt(base64.b64decode(self.data))
-            data = dec.rstrip('*')
+        if self.encoding != AVBMessage.ENC_PLAIN:
+            if self.codec is None:
+                raise ValueError('No PSK set')
+            data = self.codec.decrypt(self.encoding, self.version, self.iv, self.data)
 
-        # Parse the JSON to a dict and return
+        # Parse the JSON (or MessagePack) to a dict and return
+        if self.fmt == AVBMessage.FMT_MSGPACK:
+            if msgpack is None:
+                raise ValueError('msgpack module is not installed')
+            return msgpack.unpackb(data)
         return json.loads(data)
 
     # Returns the message length
@@ -123,37 +244,278 @@ class AVBMessage:
         print '  Length:   {:d}'.format(self.length)
         print '  Version:  {:d}'.format(self.version)
         print '  Encoding: {:d}'.format(self.encoding)
+        if self.version == AVBMessage.VER_3:
+            print '  Format:   {:d}'.format(self.fmt)
+        if self.has_id():
+            print '  Id:       {:d}'.format(self.msg_id)
         print 'AVB Body'
-        if self.encoding == AVBMessage.ENC_AES_CBC:
-            print '  IV: ' + self.iv
+        if self.encoding != AVBMessage.ENC_PLAIN:
+            if self.version == AVBMessage.VER_3:
+                print '  IV: ' + base64.b64encode(self.iv)
+            else:
+                print '  IV: ' + self.iv
         print '  ' + str(self.get_data())
 
     # Function to dump the raw string representation of the message
     def dumps(self):
+        if self.version == AVBMessage.VER_3:
+            hdr = AVBMessage.HEADER_V3.pack(AVBMessage.MAGIC, self.version, self.encoding,
+                                            self.fmt, self.length, self.msg_id)
+            return hdr + self.iv + self.data
+
         hdr = '{:0{width}d}'.format(self.length, width=AVBMessage.LENGTH_FIELD_SIZE)
         hdr = hdr + '{:0{width}d}'.format(self.version, width=AVBMessage.VERSION_FIELD_SIZE)
         hdr = hdr + '{:0{width}d}'.format(self.encoding, width=AVBMessage.ENCODING_FIELD_SIZE)
+        if self.version == AVBMessage.VER_2:
+            hdr = hdr + '{:0{width}d}'.format(self.msg_id, width=AVBMessage.ID_FIELD_SIZE)
         return hdr + self.iv + self.data
 
     # Funtion to load a message from a string (essentially a parser)
     def loads(self, msg):
-        # Check to make sure minimum length is met
-        if len(msg) < AVBMessage.HEADER_SIZE:
+        size = self.loads_header(msg)
+        if size is None or len(msg) < self.length:
             raise ValueError('Message is too small')
+        self.loads_body(memoryview(msg)[size:self.length])
 
-        # Take the header bytes and populate fields
-        i = 0
-        self.length = int(msg[i:AVBMessage.LENGTH_FIELD_SIZE])
-        i += AVBMessage.LENGTH_FIELD_SIZE
-        self.version = int(msg[i:i+AVBMessage.VERSION_FIELD_SIZE])
-        i += AVBMessage.VERSION_FIELD_SIZE
-        self.encoding = int(msg[i:i+AVBMessage.ENCODING_FIELD_SIZE])
-        i += AVBMessage.ENCODING_FIELD_SIZE
+    # Parse the header at the start of msg, which may hold more than the header
+    # (or only part of it). Returns the size of the header, or None if msg is
+    # too short to hold all of it. Raises ValueError if the header is bad (and
+    # UnsupportedVersion for a version we don't speak, which only needs the
+    # first HEADER_SIZE bytes).
+    def loads_header(self, msg):
+        if len(msg) < AVBMessage.HEADER_SIZE:
+            return None
 
-        # Strip out the IV if it is present
+        # Binary (version 3) messages start with the magic byte
+        if ord(msg[0]) == AVBMessage.MAGIC:
+            if ord(msg[1]) != AVBMessage.VER_3:
+                raise UnsupportedVersion('Unsupported version type')
+            size = AVBMessage.HEADER_V3.size
+            if len(msg) < size:
+                return None
+            (magic, self.version, self.encoding, self.fmt, self.length,
+             self.msg_id) = AVBMessage.HEADER_V3.unpack(msg[:size])
+            self.check_encoding(self.encoding)
+            if self.length > self.max_size():
+                raise ValueError('Message is too long')
+        else:
+            # Take the header bytes and populate fields
+            i = 0
+            self.length = int(msg[i:AVBMessage.LENGTH_FIELD_SIZE])
+            i += AVBMessage.LENGTH_FIELD_SIZE
+            self.version = int(msg[i:i+AVBMessage.VERSION_FIELD_SIZE])
+            i += AVBMessage.VERSION_FIELD_SIZE
+            self.encoding = int(msg[i:i+AVBMessage.ENCODING_FIELD_SIZE])
+            i += AVBMessage.ENCODING_FIELD_SIZE
+            if self.version != AVBMessage.VER_1 and self.version != AVBMessage.VER_2:
+                raise UnsupportedVersion('Unsupported version type')
+            self.check_encoding(self.encoding)
+            self.fmt = AVBMessage.FMT_JSON
+
+            # Version 2 messages carry the request id
+            self.msg_id = 0
+            size = self.header_size()
+            if len(msg) < size:
+                return None
+            if self.version == AVBMessage.VER_2:
+                self.msg_id = int(msg[i:i+AVBMessage.ID_FIELD_SIZE])
+
+        if self.length < size:
+            raise ValueError('Bad message length')
+        return size
+
+    # Load the IV and body from body, a memoryview of what follows the header
+    # (of a message whose header has been parsed with loads_header()). Each
+    # part is copied out exactly once.
+    def loads_body(self, body):
+        # Strip out the IV (or nonce) if it is present
+        n = 0
         if self.encoding == AVBMessage.ENC_AES_CBC:
-            self.iv = msg[i:i+AVBMessage.IV_SIZE]
-            i += AVBMessage.IV_SIZE
+            if self.version == AVBMessage.VER_3:
+                n = AVBMessage.RAW_IV_SIZE
+            else:
+                n = AVBMessage.IV_SIZE
+        elif self.encoding == AVBMessage.ENC_CHACHA20_POLY1305:
+            n = AVBMessage.NONCE_SIZE
+        self.iv = body[:n].tobytes()
 
         # The rest of the message is data
-        self.data = msg[i:]
+        self.data = body[n:].tobytes()
+
+# The response to a message in a protocol version we don't speak. It's a
+# version 1 message, which every client can read, listing the versions we do
+# speak so the client can send the message again in one of them.
+def version_error(psk=None):
+    if psk is not None:
+        m = AVBMessage(encoding=AVBMessage.ENC_AES_CBC, psk=psk)
+    else:
+        m = AVBMessage()
+    m.set_data({'status': 1, 'err_str': VERSION_ERROR,
+                'data': {'versions': list(AVBMessage.VERSIONS)}})
+    return m.dumps()
+
+class AVBCodec:
+    """
+    Does the encryption for messages using a PSK. The key is decoded once
+    when the codec is made, so encrypting or decrypting a message only costs
+    the cipher work. Codecs are shared by every message using the same PSK,
+    use AVBCodec.get() to look one up.
+    """
+    codecs = {}
+
+    # Return the codec for a base64 encoded PSK, making it the first time
+    @staticmethod
+    def get(psk):
+        codec = AVBCodec.codecs.get(psk)
+        if codec is None:
+            codec = AVBCodec(psk)
+            AVBCodec.codecs[psk] = codec
+        return codec
+
+    def __init__(self, psk):
+        # Key must be 16/24/32 bytes long (for our case, enforce 32 bytes)
+        if len(psk) != AVBMessage.PSK_256_SIZE:
+            raise ValueError('Bad PSK length')
+        self.psk = psk
+        self.key = base64.b64decode(psk)
+
+    # Encrypt the message body. Returns the tuple (iv, encrypted body) in the
+    # form they are sent for the message version.
+    def encrypt(self, encoding, version, data):
+        # Encrypt using a random nonce. The tag is sent after the encrypted body.
+        if encoding == AVBMessage.ENC_CHACHA20_POLY1305:
+            nonce = os.urandom(AVBMessage.NONCE_SIZE)
+            cipher = ChaCha20_Poly1305.new(key=self.key, nonce=nonce)
+            (enc, tag) = cipher.encrypt_and_digest(data)
+            return (nonce, enc + tag)
+
+        # Generate random IV and encrypt
+        iv = os.urandom(AES.block_size)
+        cipher = AES.new(self.key, AES.MODE_CBC, iv)
+        if version == AVBMessage.VER_3:
+            # The body may be binary so use PKCS#7 padding and send the IV
+            # and encrypted body as they are
+            n = AES.block_size - (len(data) % AES.block_size)
+            return (iv, cipher.encrypt(data + chr(n) * n))
+
+        pad = '*' * (AES.block_size - (len(data) % AES.block_size))
+        enc = cipher.encrypt(data + pad)
+        return (base64.b64encode(iv), base64.b64encode(enc))
+
+    # Decrypt a message body. For ChaCha20-Poly1305 this raises ValueError if
+    # the tag doesn't match.
+    def decrypt(self, encoding, version, iv, data):
+        if encoding == AVBMessage.ENC_CHACHA20_POLY1305:
+            if len(data) < AVBMessage.TAG_SIZE:
+                raise ValueError('Message is too small')
+            cipher = ChaCha20_Poly1305.new(key=self.key, nonce=iv)
+            return cipher.decrypt_and_verify(data[:-AVBMessage.TAG_SIZE],
+                                             data[-AVBMessage.TAG_SIZE:])
+
+        if version == AVBMessage.VER_3:
+            cipher = AES.new(self.key, AES.MODE_CBC, iv)
+            dec = cipher.decrypt(data)
+            return dec[:-ord(dec[-1])]
+
+        cipher = AES.new(self.key, AES.MODE_CBC, base64.b64decode(iv))
+        dec = cipher.decrypt(base64.b64decode(data))
+        return dec.rstrip('*')
+
+class AVBReader:
+    """
+    Reads AVB messages from a socket. There should be one reader per
+    connection, passed the connection's socket on each call. Data is received
+    straight into a buffer that is kept for the life of the connection (using
+    recv_into), so reading a message doesn't need a list of chunks that then
+    get joined. Anything received past the end of a message (e.g. the next pipelined
+    request) stays in the buffer for the next call.
+
+    read_message() is for blocking sockets. An event loop calls fill() when
+    the socket is readable and then parse() until it returns None.
+    """
+    def __init__(self, psk=None, size=16384):
+        self.psk = psk
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        # Unread data is buf[start:end]
+        self.start = 0
+        self.end = 0
+        # Message at start whose header has been parsed, but whose body
+        # hasn't all been received yet
+        self.msg = None
+
+    # Number of bytes received but not yet returned as a message
+    def buffered(self):
+        return self.end - self.start
+
+    # Make sure there is space for n bytes of unread data
+    def reserve(self, n):
+        count = self.buffered()
+        if self.start + n <= len(self.buf):
+            return
+        if n > len(self.buf):
+            # Message is bigger than the buffer, replace it with a bigger one
+            buf = bytearray(max(n, 2 * len(self.buf)))
+            buf[:count] = self.view[self.start:self.end]
+            self.buf = buf
+            self.view = memoryview(buf)
+        else:
+            # Move the unread data to the front of the buffer
+            self.buf[:count] = self.buf[self.start:self.end]
+        self.start = 0
+        self.end = count
+
+    # Receive whatever is available on socket s into the buffer. Returns the
+    # number of bytes received (0 if the connection was closed).
+    def fill(self, s):
+        if self.end == len(self.buf):
+            self.reserve(self.buffered() + 1)
+        n = s.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    # Return the next message if it has been fully received, otherwise None.
+    # Raises ValueError if the header is bad. The header is only parsed once
+    # per message, however many fill() calls it takes to receive the body.
+    def parse(self):
+        m = self.msg
+        if m is None:
+            if self.buffered() < AVBMessage.HEADER_SIZE:
+                return None
+
+            # The version (and request id) come from the header
+            if self.psk is not None:
+                m = AVBMessage(encoding=AVBMessage.ENC_AES_CBC, psk=self.psk)
+            else:
+                m = AVBMessage()
+
+            # No header is longer than a version 2 one
+            i = self.start
+            n = min(self.buffered(), AVBMessage.HEADER_SIZE_V2)
+            if m.loads_header(self.view[i:i+n].tobytes()) is None:
+                return None
+            self.msg = m
+            self.reserve(m.len())
+
+        # Check the whole message is here
+        length = m.len()
+        if self.buffered() < length:
+            return None
+
+        i = self.start
+        m.loads_body(self.view[i+m.header_size():i+length])
+        self.msg = None
+        self.start += length
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+        return m
+
+    # Wait for the next message on socket s
+    def read_message(self, s):
+        while True:
+            m = self.parse()
+            if m is not None:
+                return m
+            if self.fill(s) == 0:
+                raise RuntimeError('socket connection broken')
@@ -0,0 +1,129 @@
+# Lightweight tracing of a request across the Lambda client, the AVB
+# connection and the server's calls to Vera.
+#
+# A Trace collects spans (a name, when it started relative to the start of the
+# trace and how long it took). The trace for the current request is kept per
+# thread, so code deep in the call stack records a span with
+#
+#   with avbtrace.span('vera', request='status'):
+#       ...
+#
+# which costs next to nothing when no trace is active.
+#
+# The client puts the trace id in the message body ("trace": {"id": ...}).
+# A server that sees it traces the handling of the message and adds its spans
+# to the response body, so the client can log the whole request as a single
+# waterfall, e.g.
+#
+#   connect@0.0+2.1 tls_handshake@2.1+31.4 encode@33.6+0.2 send@33.8+0.1
+#   server.decode@34.0+0.1 server.vera@34.2+48.9 server.action@34.1+49.1
+#   recv@33.9+50.6 decode@84.5+0.1
+#
+# (name@start+duration, in milliseconds). The server's clock isn't the
+# client's, so its spans are placed in the middle of the time the client
+# spent waiting for the response.
+import os
+import time
+import threading
+import binascii
+
+local = threading.local()
+
+def new_id():
+    return binascii.hexlify(os.urandom(8))
+
+class Trace:
+    def __init__(self, trace_id=None, start=None):
+        if trace_id is None:
+            trace_id = new_id()
+        if start is None:
+            start = time.time()
+        self.id = trace_id
+        self.start = start
+        # List of (name, start ms, duration ms, fields). Batch actions record
+        # spans from several threads.
+        self.spans = []
+        self.lock = threading.Lock()
+
+    # Record a span that ran from start to end (time.time() values)
+    def add(self, name, start, end, **fields):
+        span = (name, (start - self.start) * 1000, (end - start) * 1000, fields)
+        with self.lock:
+            self.spans.append(span)
+
+    # Milliseconds since the trace started
+    def elapsed(self):
+        return (time.time() - self.start) * 1000
+
+    # The trace as it is sent in a response body
+    def to_dict(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: s[1])
+        return {'id': self.id,
+                'ms': round(self.elapsed(), 3),
+                'spans': [dict(f, name=n, start_ms=round(s, 3), ms=round(d, 3))
+                          for (n, s, d, f) in spans]}
+
+    # Add the spans of a remote trace (from to_dict()) with their names prefixed
+    # by prefix. sent and received are the times (time.time()) the request was
+    # sent and the response arrived, the remote spans are centred in between.
+    def merge(self, remote, prefix, sent, received):
+        try:
+            wait = (received - sent) * 1000
+            offset = (sent - self.start) * 1000 + max(0.0, (wait - float(remote['ms'])) / 2)
+            spans = [(prefix + s['name'], offset + float(s['start_ms']), float(s['ms']), {})
+                     for s in remote['spans']]
+        except (KeyError, TypeError, ValueError):
+            # Not something we can make sense of, don't let it break the request
+            return
+        with self.lock:
+            self.spans += spans
+
+    # One line summary of the spans, in the order they started
+    def waterfall(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: s[1])
+        return ' '.join('{:s}@{:.1f}+{:.1f}'.format(n, s, d) for (n, s, d, f) in spans)
+
+class Span:
+    def __init__(self, trace, name, fields):
+        self.trace = trace
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.fields['error'] = exc_type.__name__
+        self.trace.add(self.name, self.start, time.time(), **self.fields)
+        return False
+
+class NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NO_SPAN = NoSpan()
+
+# The trace active on this thread (or None)
+def current():
+    return getattr(local, 'trace', None)
+
+# Make trace the active trace on this thread (None to clear it). Returns the
+# trace that was active before.
+def activate(trace):
+    previous = current()
+    local.trace = trace
+    return previous
+
+# Time a block of code as a span of the active trace, if there is one
+def span(name, **fields):
+    trace = current()
+    if trace is None:
+        return NO_SPAN
+    return Span(trace, name, fields)
@@ -5,9 +5,21 @@ using the Alexa Skills Kit.
 
 from __future__ import print_function
 import socket, ssl
+import select
+import time
 import json
 import ConfigParser
-from avbmsg import AVBMessage
+import weakref
+from avbmsg import AVBMessage, AVBReader, VERSION_ERROR, FORMAT_ERROR
+import avblog
+import avbtrace
+
+# Lambda sends whatever we write to stdout to CloudWatch. Records are written
+# as they are logged rather than queued, since the container is frozen as soon
+# as the handler returns. The [log] section of the configuration file can
+# change this once it has been read.
+avblog.setup(queue_size=0)
+log = avblog.get_logger('client')
 
 """
 The lambda_handler is the entry point of our Lambda function. ASK always invokes
@@ -19,20 +31,21 @@ Arguments:
  - context: Provides runtime information to the Lambda function
  """
 def lambda_handler(event, context):
-    
-    # Print out some information specific to our Lambda configuration
-    # NOTE: print() functions are logged to CloudWatch logs.
+    start = time.time()
+
+    # Log some information specific to our Lambda configuration
+    # NOTE: anything written to stdout is logged to CloudWatch logs.
     # NOTE: sometimes context can be None for a test that locally invokes this function
     if context is not None:
-        print('Log stream name: ', context.log_stream_name)
-        print('Log group name: ', context.log_group_name)
-        print('Request ID: ', context.aws_request_id)
-        print('Mem. limits(MB): ', context.memory_limit_in_mb)
-        print('Time remaining (ms): ', context.get_remaining_time_in_millis())
-    
+        log.debug('lambda context', extra=avblog.kv(
+            log_stream=context.log_stream_name,
+            log_group=context.log_group_name,
+            aws_request_id=context.aws_request_id,
+            memory_mb=context.memory_limit_in_mb,
+            remaining_ms=context.get_remaining_time_in_millis()))
+
     # Log the applicationID for the ASK skill that invoked us
-    print('event.session.application.applicationId=' +
-          event['session']['application']['applicationId'])
+    log.debug('invoked', extra=avblog.kv(app_id=event['session']['application']['applicationId']))
 
     # Uncomment this if statement and populate with your skill's application ID to
     # prevent someone else from configuring a skill that sends requests to this function.
@@ -42,22 +55,41 @@ def lambda_handler(event, context):
 
     req = event['request']
     ses = event['session']
-    
-    # Log the start of a new session. Note that the Lambda code might get called several
-    # times if the user has multiple utterance interactions with your skill.
-    if event['session']['new']:
-        print('New Sesssion: rId=' + req['requestId'] + ', sId=' + ses['sessionId'])
+
+    # If tracing is turned on, time each step of the invocation (including
+    # the server's side of it)
+    trace = None
+    if get_vera_connection().trace:
+        trace = avbtrace.Trace(start=start)
+        avbtrace.activate(trace)
 
     # The request type lets us know what the user wants to do.
-    if req['type'] == 'LaunchRequest':
-        print('Launch: rId=' + req['requestId'] + ', sId=' + ses['sessionId'])
-        return on_launch(req, ses)
-    elif req['type'] == 'IntentRequest':
-        print('Intent: rId=' + req['requestId'] + ', sId=' + ses['sessionId'])
-        return on_intent(req, ses)
-    elif req['type'] == 'SessionEndedRequest':
-        print('Session Ended rId=' + req['requestId'] + ', sId=' + ses['sessionId'])
-        return on_session_ended(req, ses)
+    try:
+        if req['type'] == 'LaunchRequest':
+            r = on_launch(req, ses)
+        elif req['type'] == 'IntentRequest':
+            r = on_intent(req, ses)
+        elif req['type'] == 'SessionEndedRequest':
+            r = on_session_ended(req, ses)
+        else:
+            return
+    finally:
+        avbtrace.activate(None)
+
+    # One line per invocation. Note that the Lambda code might get called several
+    # times if the user has multiple utterance interactions with your skill.
+    fields = {'type': req['type'],
+              'request_id': req['requestId'],
+              'session_id': ses['sessionId'],
+              'new_session': ses['new'],
+              'ms': (time.time() - start) * 1000}
+    if req['type'] == 'IntentRequest':
+        fields['intent'] = req['intent']['name']
+    if trace is not None:
+        fields['trace'] = trace.id
+        fields['spans'] = trace.waterfall()
+    log.info('handled request', extra={'fields': fields})
+    return r
 
 """
 Called when the user launches the skill without specifying what they want
@@ -76,23 +108,26 @@ def on_intent(intent_request, session):
     if intent_name == 'AMAZON.HelpIntent':
         return get_welcome_response()
 
-    # Try connecting to the Vera server
-    (socket, msg) = open_connection_to_vera()
+    # Try connecting to the Vera server. If an earlier invocation in this
+    # container left a connection open we carry on using it.
+    conn = get_vera_connection()
+    (socket, msg) = conn.connect()
     if socket == None:
         return get_error_response(msg)
 
     # Dispatch to your skill's intent handlers
     if intent_name == 'DeviceGetIntent':
-        r = get_device(socket, intent, session)
+        r = get_device(conn, intent, session)
     elif intent_name == 'DeviceSetIntent':
-        r = set_device(socket, intent, session)
+        r = set_device(conn, intent, session)
     elif intent_name == 'RunSceneIntent':
-        r = run_scene(socket, intent, session)
+        r = run_scene(conn, intent, session)
     else:
-        close_connection_to_vera(socket)
+        conn.disconnect()
         raise ValueError('Invalid intent')
 
-    close_connection_to_vera(socket)
+    if not conn.keep_open:
+        conn.disconnect()
     return r
 
 """
@@ -104,167 +139,517 @@ def on_session_ended(session_ended_request, session):
     return
 
 # --------------- Functions that connect to the listening server ------------------
+
+# Raised when the server doesn't speak our protocol version. It hasn't acted on
+# the message, so it can be sent again in one of the versions it listed.
+class VersionRejected(RuntimeError):
+    def __init__(self, versions):
+        RuntimeError.__init__(self, VERSION_ERROR)
+        self.versions = versions
+
+# Raised when the server can't read our body format (it doesn't have msgpack).
+# It hasn't acted on the message, so it can be sent again in JSON.
+class FormatRejected(RuntimeError):
+    def __init__(self, formats):
+        RuntimeError.__init__(self, FORMAT_ERROR)
+        self.formats = formats
+
+class VeraConnection:
+    """
+    Holds everything needed to talk to the server: the settings from the
+    configuration file, the PSK and the SSLContext (with the CA, certificate and
+    key already loaded). Lambda reuses the container (and this module) for
+    invocations that come close together, so all of this is loaded once and
+    shared by every warm invocation instead of being read from disk for each
+    intent. Call reload() to pick up changes to the files.
+
+    With keep_open set, connect()/request() go one step further and keep the
+    connection itself open between invocations, so a follow up utterance
+    doesn't need a TCP or TLS handshake at all. Before reusing the connection
+    we check it is still alive and reconnect if the server has closed it.
+    """
+    def __init__(self, cfg_file='client.cfg'):
+        self.cfg_file = cfg_file
+        # The AVBReader (and its receive buffer) for each open socket
+        self.readers = weakref.WeakKeyDictionary()
+        self.reload()
+
+    """
+    Read the configuration file (and the security assets it points to). If
+    something is wrong, error is set to a message describing the problem and
+    open() will fail with that message.
+    """
+    def reload(self):
+        # Drop any connection made with the old settings
+        self.disconnect()
+        self.readers.clear()
+
+        self.error = None
+        self.security = None
+        self.hostname = None
+        self.port = None
+        self.psk = None
+        self.encoding = AVBMessage.ENC_AES_CBC
+        self.context = None
+        self.keep_open = True
+        self.trace = False
+        self.idle_timeout = 4.5
+        self.version = AVBMessage.VER_1
+        self.fmt = AVBMessage.FMT_JSON
+        self.next_id = 0
+
+        # Read the configuration file
+        cfg = ConfigParser.RawConfigParser()
+        try:
+            cfg.readfp( open(self.cfg_file) )
+        except:
+            self.error = 'error reading configuration file'
+            return
+
+        try:
+            avblog.setup_from_config(cfg, queue_size=0)
+        except ValueError as e:
+            self.error = str(e)
+            return
+        if cfg.has_option('log', 'trace'):
+            self.trace = cfg.getboolean('log', 'trace')
+
+        # Make sure we have the server details
+        if cfg.has_section('server'):
+            if cfg.has_option('server', 'port'):
+                self.port = cfg.getint('server', 'port')
+            else:
+                self.error = 'missing port option in configuration file'
+                return
+            if cfg.has_option('server', 'host'):
+                self.hostname = cfg.get('server', 'host')
+            else:
+                self.error = 'missing hostname in configuration file'
+                return
+        else:
+            self.error = 'missing server section in configuration file'
+            return
+
+        # Should the connection stay open between invocations, and for how long
+        # can it sit idle. This should be less than the idle timeout of the
+        # server so we don't try to use a connection the server is closing.
+        if cfg.has_option('server', 'keep_open'):
+            self.keep_open = cfg.getboolean('server', 'keep_open')
+        if cfg.has_option('server', 'idle_timeout'):
+            self.idle_timeout = cfg.getfloat('server', 'idle_timeout')
+
+        # Version of the AVB protocol to use. Version 2 lets us pipeline
+        # several requests on the connection, version 3 also uses a compact
+        # binary header and doesn't base64 encode the encrypted body. If the
+        # server doesn't speak the version it tells us which ones it does and
+        # we fall back to the best of those.
+        if cfg.has_option('server', 'protocol'):
+            self.version = cfg.getint('server', 'protocol')
+            if self.version not in AVBMessage.VERSIONS:
+                self.error = 'invalid protocol version in configuration file'
+                return
+
+        # Format of the message body, version 3 can use MessagePack instead of
+        # JSON (needs the msgpack module)
+        if cfg.has_option('server', 'format'):
+            fmt = cfg.get('server', 'format')
+            if fmt == 'msgpack':
+                if self.version == AVBMessage.VER_3 and AVBMessage.HAVE_MSGPACK:
+                    self.fmt = AVBMessage.FMT_MSGPACK
+                else:
+                    log.warning('msgpack needs protocol 3 and the msgpack module, using json')
+            elif fmt != 'json':
+                self.error = 'invalid format in configuration file'
+                return
+
+        # See what security options are specified in the config file
+        # Valid combinations are:
+        #   1) none - just do regular connection (INSECURE)
+        #   2) just the section - use ssl/tls but with no auth
+        #   3) root_ca plus client cert/key- mutual auth
+        security = 'none'
+        ciphers = None
+        if cfg.has_section('security'):
+            security = 'ssl'
+            if cfg.has_option('security', 'root_ca') and cfg.has_option('security', 'cert') and cfg.has_option('security', 'key'):
+                security='ssl_mutual_auth'
+                root_ca = cfg.get('security', 'root_ca')
+                cert = cfg.get('security', 'cert')
+                key = cfg.get('security', 'key')
+
+            if cfg.has_option('security', 'ciphers'):
+                ciphers = cfg.get('security', 'ciphers')
+
+            # Cipher used with the PSK. ChaCha20-Poly1305 needs protocol 3
+            # (and PyCryptodome on both ends).
+            if cfg.has_option('security', 'psk_encoding'):
+                encoding = cfg.get('security', 'psk_encoding')
+                if encoding == 'chacha20-poly1305':
+                    if self.version == AVBMessage.VER_3 and AVBMessage.HAVE_CHACHA20_POLY1305:
+                        self.encoding = AVBMessage.ENC_CHACHA20_POLY1305
+                    else:
+                        log.warning('chacha20-poly1305 needs protocol 3 and PyCryptodome, using aes-cbc')
+                elif encoding != 'aes-cbc':
+                    self.error = 'invalid psk_encoding in configuration file'
+                    return
+
+            if cfg.has_option('security', 'psk'):
+                try:
+                    f = open(cfg.get('security', 'psk'), 'r')
+                    # Note that the newline gets read, so we need to strip it
+                    self.psk = f.read().rstrip('\n')
+                    f.close()
+                except IOError as e:
+                    log.error('error reading PSK', extra=avblog.kv(errno=e.errno, error=e.strerror))
+                    self.psk = None
+
+        log.info('configuring client security profile', extra=avblog.kv(security=security))
+        if self.psk is not None:
+            log.info('using PSK', extra=avblog.kv(path=cfg.get('security', 'psk')))
+
+        # Create the SSL context depending on the credentials given in the config file
+        if security == 'ssl':
+            self.context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
+            self.context.set_ciphers('HIGH')
+            self.context.check_hostname = False
+            self.context.verify_mode = ssl.CERT_NONE
+        elif security == 'ssl_mutual_auth':
+            self.context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+            try:
+                self.context.load_verify_locations(root_ca)
+                self.context.load_cert_chain(certfile=cert, keyfile=key)
+            except (IOError, ssl.SSLError):
+                self.error = 'error loading security assets'
+                return
+            self.context.verify_mode = ssl.CERT_REQUIRED
+
+        # Optionally restrict the cipher suites (e.g. to ECDHE suites, which
+        # are much cheaper for the server to handshake on ARM)
+        if self.context is not None and ciphers is not None:
+            self.context.set_ciphers(ciphers)
+
+        self.security = security
+
+    """
+    Connect to the server.
+
+    Returns:
+        Tuple containing socket to use (or None if error) and the error message
+        (or None on success)
+    """
+    def open(self):
+        if self.error is not None:
+            return (None, self.error)
+
+        # Create the socket
+        sock = None
+        if self.security == 'none':
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            log.debug('connect (INSECURE)', extra=avblog.kv(host=self.hostname, port=self.port))
+        else:
+            # Create the socket and wrap it in our context to secure
+            # By specifying server_hostname we require the server's certificate to match the
+            # hostname we provide.
+            # The handshake is done separately so it can be timed on its own.
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock = self.context.wrap_socket(s, server_hostname=self.hostname,
+                                            do_handshake_on_connect=False)
+            log.debug('connect (SSL/TLS)', extra=avblog.kv(host=self.hostname, port=self.port))
+
+        # Try to connect
+        start = time.time()
+        try:
+            with avbtrace.span('connect'):
+                sock.connect((self.hostname, self.port))
+            if self.security != 'none':
+                with avbtrace.span('tls_handshake'):
+                    sock.do_handshake()
+        except socket.error as msg:
+            log.error('socket error', extra=avblog.kv(errno=msg[0], error=msg[1]))
+            return (None, msg[1])
+        log.info('connected', extra=avblog.kv(
+            host=self.hostname, port=self.port, security=self.security,
+            ms=(time.time() - start) * 1000))
+
+        # On successful connection return the secure socket
+        return (sock, None)
+
+    def close(self, s):
+        # Close the socket
+        self.readers.pop(s, None)
+        s.close()
+        log.debug('closed connection')
+
+    """
+    Get the persistent connection to the server, opening a new one if we don't
+    have one or the one we have is no longer usable.
+
+    Returns:
+        Tuple containing socket to use (or None if error) and the error message
+        (or None on success)
+    """
+    def connect(self):
+        if self.sock is not None:
+            if self.is_alive():
+                self.reused = True
+                return (self.sock, None)
+            log.info('connection is stale, reconnecting')
+            self.disconnect()
+
+        (self.sock, msg) = self.open()
+        self.reused = False
+        self.last_used = time.time()
+        return (self.sock, msg)
+
+    def disconnect(self):
+        if getattr(self, 'sock', None) is not None:
+            self.close(self.sock)
+        self.sock = None
+        self.reused = False
+        self.last_used = None
+
+    # Check whether the persistent connection can still be used. An idle
+    # connection should have nothing to read, so if select() says it is
+    # readable the server has closed it (or sent something we didn't ask for).
+    def is_alive(self):
+        if time.time() - self.last_used > self.idle_timeout:
+            return False
+        try:
+            (r, w, x) = select.select([self.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return len(r) == 0
+
+    """
+    Send a message over the persistent connection and return the response. If
+    the send fails on a connection we reused from an earlier invocation, the
+    server must have dropped it so we reconnect and try once more.
+    """
+    def request(self, data):
+        return self.retry_on_stale(self.send, data)
+
+    """
+    Send a list of messages over the persistent connection and return the list
+    of responses (in the same order). With protocol version 2+ all the messages
+    are sent before waiting for any responses, so the whole list costs a single
+    round trip and the server can work on them at the same time.
+    """
+    def request_many(self, data_list):
+        return self.retry_on_stale(self.send_many, data_list)
+
+    """
+    Send a list of actions (e.g. to turn off every light in a room) as a single
+    batch message. The server runs them in parallel and returns one response
+    whose data is the list of responses to the individual actions.
+    """
+    def request_batch(self, actions):
+        return self.request({'batch': actions})
+
+    # Call fn(s, arg) on the persistent connection (see try_request()) and log
+    # how long it took. With tracing on, the request is traced unless the
+    # caller (lambda_handler) is already tracing.
+    def retry_on_stale(self, fn, arg):
+        start = time.time()
+        trace = None
+        if self.trace and avbtrace.current() is None:
+            trace = avbtrace.Trace(start=start)
+            avbtrace.activate(trace)
+        try:
+            (resp, reused) = self.try_request(fn, arg)
+        finally:
+            if trace is not None:
+                avbtrace.activate(None)
+
+        fields = {'version': self.version,
+                  'reused': reused,
+                  'ms': (self.last_used - start) * 1000}
+        if trace is not None:
+            fields['trace'] = trace.id
+            fields['spans'] = trace.waterfall()
+        log.info('request done', extra={'fields': fields})
+        return resp
+
+    # Call fn(s, arg) on the persistent connection and return the tuple
+    # (response, whether the connection was reused). If it fails on a
+    # connection we reused from an earlier invocation, the server must have
+    # dropped it so we reconnect and try once more.
+    def try_request(self, fn, arg):
+        (s, msg) = self.connect()
+        if s is None:
+            raise RuntimeError(msg)
+
+        try:
+            resp = fn(s, arg)
+        except (socket.error, RuntimeError) as e:
+            reused = self.reused
+            self.disconnect()
+            if isinstance(e, VersionRejected):
+                self.downgrade(e.versions)
+            elif isinstance(e, FormatRejected):
+                log.warning('server cannot read msgpack, falling back to json',
+                            extra=avblog.kv(formats=e.formats))
+                self.fmt = AVBMessage.FMT_JSON
+            elif reused:
+                log.info('reused connection failed, reconnecting', extra=avblog.kv(error=str(e)))
+            else:
+                raise
+            (s, msg) = self.connect()
+            if s is None:
+                raise RuntimeError(msg)
+            resp = fn(s, arg)
+
+        reused = self.reused
+        self.reused = True
+        self.last_used = time.time()
+        return (resp, reused)
+
+    # Switch to the best protocol version the server says it speaks (and that
+    # is older than the one it turned down)
+    def downgrade(self, versions):
+        old = self.version
+        ours = [v for v in versions if v in AVBMessage.VERSIONS and v < old]
+        self.version = max(ours) if ours else AVBMessage.VER_1
+        if self.version != AVBMessage.VER_3:
+            self.fmt = AVBMessage.FMT_JSON
+            self.encoding = AVBMessage.ENC_AES_CBC
+        log.warning('server does not speak protocol version, falling back',
+                    extra=avblog.kv(version=old, new_version=self.version))
+
+    # Create an AVB message using the PSK (if we have one). Version 2+ messages
+    # are given the next request id.
+    def new_message(self):
+        if self.psk is not None:
+            m = AVBMessage(version=self.version, encoding=self.encoding, psk=self.psk, fmt=self.fmt)
+        else:
+            m = AVBMessage(version=self.version, fmt=self.fmt)
+        if m.has_id():
+            self.next_id = (self.next_id + 1) % (AVBMessage.MAX_ID + 1)
+            m.set_id(self.next_id)
+        return m
+
+    def send(self, s, data):
+        return self.send_many(s, [data])[0]
+
+    def send_many(self, s, data_list):
+        # If we're tracing, ask the server to trace the messages too
+        trace = avbtrace.current()
+
+        # Encode the messages and send to Vera
+        msgs = []
+        with avbtrace.span('encode'):
+            for data in data_list:
+                if trace is not None and isinstance(data, dict):
+                    data = dict(data, trace={'id': trace.id})
+                m = self.new_message()
+                m.set_data(data)
+                msgs.append(m)
+
+        # With version 1 we have to wait for each response before sending
+        # the next message
+        if self.version == AVBMessage.VER_1:
+            resps = []
+            for m in msgs:
+                raw = m.dumps()
+                if avblog.want_payload(log):
+                    log.debug('sending msg', extra=avblog.kv(raw=raw))
+                with avbtrace.span('send'):
+                    s.sendall(raw)
+                sent = time.time()
+                resps.append(self.recv_response(s, trace, sent)[1])
+            return resps
+
+        # Otherwise pipeline them and match the responses up by request id
+        out = []
+        for m in msgs:
+            raw = m.dumps()
+            if avblog.want_payload(log):
+                log.debug('sending msg', extra=avblog.kv(raw=raw))
+            out.append(raw)
+        with avbtrace.span('send'):
+            s.sendall(''.join(out))
+        sent = time.time()
+
+        resps = {}
+        while len(resps) < len(msgs):
+            (msg_id, data) = self.recv_response(s, trace, sent)
+            resps[msg_id] = data
+        return [resps.get(m.get_id()) for m in msgs]
+
+    # Wait for a response and return the tuple (request id, data). If we're
+    # tracing, the server's spans are taken out of the data and added to the
+    # trace (sent is when the request went out).
+    def recv_response(self, s, trace, sent):
+        with avbtrace.span('recv'):
+            m = self.recv_message(s)
+        received = time.time()
+        with avbtrace.span('decode'):
+            data = m.get_data()
+        # An older server answers a message in a version it doesn't speak with
+        # a version 1 error listing the versions it does
+        if m.version != self.version and isinstance(data, dict) and data.get('err_str') == VERSION_ERROR:
+            versions = data.get('data')
+            if isinstance(versions, dict) and isinstance(versions.get('versions'), list):
+                raise VersionRejected(versions['versions'])
+            raise VersionRejected([])
+        # Likewise for a body format it can't read
+        if self.fmt != AVBMessage.FMT_JSON and isinstance(data, dict) and data.get('err_str') == FORMAT_ERROR:
+            formats = data.get('data')
+            if isinstance(formats, dict) and isinstance(formats.get('formats'), list):
+                raise FormatRejected(formats['formats'])
+            raise FormatRejected([])
+        if trace is not None and isinstance(data, dict) and 'trace' in data:
+            trace.merge(data.pop('trace'), 'server.', sent, received)
+        return (m.get_id(), data)
+
+    # Wait for a message from the server. The reader for the socket keeps its
+    # buffer between calls, so the data for any further pipelined responses
+    # that arrived with this one is kept for the next call.
+    def recv_message(self, s):
+        reader = self.readers.get(s)
+        if reader is None:
+            reader = AVBReader(self.psk)
+            self.readers[s] = reader
+        m = reader.read_message(s)
+
+        if avblog.want_payload(log):
+            log.debug('resp', extra=avblog.kv(raw=m.dumps()))
+        return m
+
 """
-This function reads the configuration file to determine the server to connect to
-and the root CA, certificate, and key to use. The name of the config file,
-client.cfg, is the only hardcoded part of the client code. The rest of the parameters
-are configurable through the config file.
+The connection is created the first time it's needed and then kept for as long
+as Lambda keeps this container around.
+"""
+vera_connection = None
+
+def get_vera_connection():
+    global vera_connection
+    if vera_connection is None:
+        vera_connection = VeraConnection()
+    return vera_connection
+
+"""
+Connect to the server described by the configuration file (client.cfg). The
+name of the config file is the only hardcoded part of the client code. The rest
+of the parameters are configurable through the config file.
 
 Returns:
     Tuple containing socket to use (or None if error) and the error message
     (or None on success)
 """
 def open_connection_to_vera():
-    # Read the configuration file
-    cfg = ConfigParser.RawConfigParser()
-    try:
-        cfg.readfp( open('client.cfg') )
-    except:
-        return (None, 'error reading configuration file')
-
-    # Make sure we have the server details
-    if cfg.has_section('server'):
-        if cfg.has_option('server', 'port'):
-            port = cfg.getint('server', 'port')
-        else:
-            return (None, 'missing port option in configuration file')
-        if cfg.has_option('server', 'host'):
-            hostname = cfg.get('server', 'host')
-        else:
-            return (None, 'missing hostname in configuration file')
-    else:
-        return (None, 'missing server section in configuration file')
-
-    # See what security options are specified in the config file
-    # Valid combinations are:
-    #   1) none - just do regular connection (INSECURE)
-    #   2) just the section - use ssl/tls but with no auth
-    #   3) root_ca plus client cert/key- mutual auth
-    security = 'none'
-    psk = None
-    if cfg.has_section('security'):
-        security = 'ssl'
-        if cfg.has_option('security', 'root_ca') and cfg.has_option('security', 'cert') and cfg.has_option('security', 'key'):
-            security='ssl_mutual_auth'
-            root_ca = cfg.get('security', 'root_ca')
-            cert = cfg.get('security', 'cert')
-            key = cfg.get('security', 'key')
-
-        if cfg.has_option('security', 'psk'):
-            try:
-                f = open(cfg.get('security', 'psk'), 'r')
-                # Note that the newline gets read, so we need to strip it
-                psk = f.read().rstrip('\n')
-                f.close()
-            except IOError as e:
-                #print 'I/O error({0}): {1}'.format(e.errno, e.strerror)
-                psk = None
-
-    print ('configuring client security profile as "' + security + '"')
-    if psk is not None:
-        print ('using PSK from ' + cfg.get('security', 'psk'))
-
-    # Create the socket
-    sock = None
-    if security == 'none':
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        print ('connect to ' + hostname + ':' + str(port) + ' (INSECURE)')
-    elif security == 'ssl' or security == 'ssl_mutual_auth':
-        # Create the SSL context depending on the credentials given in the config file
-        if (security == 'ssl'):
-            context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-            context.set_ciphers('HIGH')
-            context.check_hostname = False
-            context.verify_mode = ssl.CERT_NONE
-        else:
-            context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-            context.load_verify_locations(root_ca)
-            context.verify_mode = ssl.CERT_REQUIRED
-            context.load_cert_chain(certfile=cert, keyfile=key)
-    
-        # Create the socket and wrap it in our context to secure
-        # By specifying server_hostname we require the server's certificate to match the
-        # hostname we provide
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock = context.wrap_socket(s, server_hostname=hostname)
-        print ('connect to ' + hostname + ':' + str(port) + ' (SSL/TLS)')
-    else:
-        # We don't have a valid security context
-        return (None, 'invalid security context')
-
-    # Try to connect
-    try:
-        sock.connect((hostname, port))
-    except socket.error as msg:
-        print ('socket error (' + str(msg[0]) + '): ' + msg[1])
-        return (None, msg[1])
-
-    # On successful connection return the secure socket
-    return (sock, None)
+    return get_vera_connection().open()
 
 def close_connection_to_vera(s):
-    # Close the socket
-    s.close()
-    print ('closed connection')
+    get_vera_connection().close(s)
 
 def send_vera_message(s, data):
-    """
-    FIXME - reading PSK
-    It's sort of a hack that I have to do this because there's no clean way to
-    pass the psk read from open_connection_to_vera() to this function. I should
-    probably make the whole client connection part a class at some point and
-    just have the psk be a member of that class so I don't have to read it here
-    again.
-    """
-    # Read the configuration file
-    psk = None
-    cfg = ConfigParser.RawConfigParser()
-    cfg.readfp( open('client.cfg') )
-    if cfg.has_section('security'):
-        if cfg.has_option('security', 'psk'):
-            # This worked on open so it should work again
-            f = open(cfg.get('security', 'psk'), 'r')
-            # Note that the newline gets read, so we need to strip it
-            psk = f.read().rstrip('\n')
-            f.close()
-
-    # Setup the AVB message
-    if psk is not None:
-        m = AVBMessage(encoding=AVBMessage.ENC_AES_CBC, psk=psk)
-    else:
-        m = AVBMessage()
-
-    # Encode the message, send to Vera, and wait for response
-    m.set_data(data)
-    print ('sending msg: ' + m.dumps())
-    s.sendall(m.dumps())
-
-    # Get a new message header
-    chunks = []
-    nb = 0
-    while nb < AVBMessage.HEADER_SIZE:
-        chunk = s.recv(AVBMessage.HEADER_SIZE - nb)
-        if chunk == '':
-            raise RuntimeError('socket connection broken')
-        chunks.append(chunk)
-        nb += len(chunk)
-    resp = ''.join(chunks)
-
-    # Get the length and wait for the rest
-    m.loads(resp[0:AVBMessage.HEADER_SIZE])
-    while nb < m.len():
-        chunk = s.recv(min(m.len() - nb, 1024))
-        if chunk == '':
-            raise RuntimeError('socket connection broken')
-        chunks.append(chunk)
-        nb += len(chunk)
-    resp = ''.join(chunks)
-    m.loads(resp)
-
-    print ('resp: ' + m.dumps())
-        
-    # Decode the received message
-    return m.get_data()
+    return get_vera_connection().send(s, data)
+
+def send_vera_messages(s, data_list):
+    return get_vera_connection().send_many(s, data_list)
+
+def send_vera_batch(s, actions):
+    return get_vera_connection().send(s, {'batch': actions})
 
 
 # --------------- Functions that control the skill's behavior ------------------
@@ -290,7 +675,22 @@ def get_error_response(msg):
     return build_response({}, build_speechlet_response(
         'vera error', speech_output, None, True))
 
-def get_device(socket, intent, session):
+# The part of a message that says which device or scene to act on. Numbers are
+# sent as the id, anything else (e.g. "bedroom light") as a name for the
+# server to look up.
+def target(value):
+    try:
+        return {'id': int(value)}
+    except ValueError:
+        return {'name': value}
+
+# What to say when the server couldn't carry out a request
+def error_speech(resp):
+    if resp['err_str'] == 'ambiguous name':
+        return 'Which one do you mean, ' + ' or '.join(m['name'] for m in resp['data']) + '?'
+    return 'Error. ' + resp['err_str']
+
+def get_device(conn, intent, session):
     session_attributes = {}
     should_end_session = False
 
@@ -298,13 +698,13 @@ def get_device(socket, intent, session):
         device = intent['slots']['Device']['value']
         session_attributes = {}
         
-        data = { 'id':int(device), 'action': {'type': 'get' } }
+        data = dict(target(device), action={'type': 'get'})
         
-        resp = send_vera_message(socket, data)
+        resp = conn.request(data)
         if resp['status'] == 0:
             speech_output = 'Device ' + resp['data']['name'] + ' is ' + resp['data']['status']
         else:
-            speech_output = 'Error. ' + resp['err_str']
+            speech_output = error_speech(resp)
         
         reprompt_text = None
         should_end_session = True
@@ -315,7 +715,7 @@ def get_device(socket, intent, session):
     return build_response(session_attributes, build_speechlet_response(
         intent['name'], speech_output, reprompt_text, should_end_session))
     
-def set_device(socket, intent, session):
+def set_device(conn, intent, session):
     session_attributes = {}
     should_end_session = False
 
@@ -330,13 +730,15 @@ def set_device(socket, intent, session):
             value = 0
         else:
             value = 0
-        data = { 'id':int(device), 'action': {'type': 'set', 'attribute': {'power':value} } }
+        data = dict(target(device), action={'type': 'set', 'attribute': {'power':value}})
         
-        resp = send_vera_message(socket, data)
+        resp = conn.request(data)
         if resp['status'] == 0:
+            if resp['data'] is not None:
+                device = resp['data']['name']
             speech_output = 'Successfully turned device ' + device + " " + action
         else:
-            speech_output = 'Error. ' + resp['err_str']
+            speech_output = error_speech(resp)
         
         reprompt_text = None
         should_end_session = True
@@ -347,7 +749,7 @@ def set_device(socket, intent, session):
     return build_response(session_attributes, build_speechlet_response(
         intent['name'], speech_output, reprompt_text, should_end_session))
 
-def run_scene(socket, intent, session):
+def run_scene(conn, intent, session):
     session_attributes = {}
     should_end_session = False
 
@@ -355,13 +757,15 @@ def run_scene(socket, intent, session):
         scene = intent['slots']['Scene']['value']
         session_attributes = {}
         
-        data = { 'id':int(scene), 'action': {'type': 'run' } }
+        data = dict(target(scene), action={'type': 'run'})
         
-        resp = send_vera_message(socket, data)
+        resp = conn.request(data)
         if resp['status'] == 0:
+            if resp['data'] is not None:
+                scene = resp['data']['name']
             speech_output = 'Successfully executed scene ' + scene 
         else:
-            speech_output = 'Error. ' + resp['err_str']
+            speech_output = error_speech(resp)
         
         reprompt_text = None
         should_end_session = True
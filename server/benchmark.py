@@ -0,0 +1,198 @@
+#!/usr/bin/python
+"""
+Microbenchmarks for the per-message CPU cost of the bridge. Nothing here needs
+a server, Vera or the network so it can be run anywhere (e.g. on the Pi the
+server runs on) to compare one version of the code with another.
+
+Covers:
+ - AVBMessage set_data/get_data/dumps/loads for each protocol version and
+   encoding, across a range of payload sizes
+ - framing messages with AVBReader
+ - handle_msg building the response to a message (in simulation mode, so the
+   time doesn't include talking to Vera)
+
+Run with --json to get the results as JSON (one object per benchmark plus
+some information about the machine) for saving and comparing later.
+
+Note that you must have .. in your PYTHONPATH variable for this to work
+(e.g. export PYTHONPATH=..)
+"""
+import os
+import argparse
+import base64
+import json
+import platform
+import timeit
+import Crypto
+from avbmsg import AVBMessage, AVBReader
+import server
+
+# Size of the padding added to the message data for each benchmark
+PAYLOAD_SIZES = [0, 256, 2048, 6000, 65536]
+
+# Number of messages in the stream read by the framing benchmark
+FRAMING_MESSAGES = 100
+
+# Stands in for the socket when framing messages. The stream is returned in
+# chunks of up to chunk_size bytes, like data arriving from the network.
+class StreamSocket:
+    def __init__(self, data, chunk_size):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.pos = 0
+
+    def recv_into(self, buf):
+        n = min(len(buf), self.chunk_size, len(self.data) - self.pos)
+        buf[:n] = self.data[self.pos:self.pos+n]
+        self.pos += n
+        return n
+
+# Throws away the response written by handle_msg
+class NullWriter:
+    def sendall(self, data):
+        pass
+
+# The combinations of version and encoding to benchmark
+def profiles():
+    p = []
+    for version in (AVBMessage.VER_1, AVBMessage.VER_2, AVBMessage.VER_3):
+        p.append((version, AVBMessage.ENC_PLAIN))
+        p.append((version, AVBMessage.ENC_AES_CBC))
+    if AVBMessage.HAVE_CHACHA20_POLY1305:
+        p.append((AVBMessage.VER_3, AVBMessage.ENC_CHACHA20_POLY1305))
+    return p
+
+def make_message(version, encoding, psk, data=None):
+    if encoding == AVBMessage.ENC_PLAIN:
+        m = AVBMessage(version=version)
+    else:
+        m = AVBMessage(version=version, encoding=encoding, psk=psk)
+    if m.has_id():
+        m.set_id(1)
+    if data is not None:
+        m.set_data(data)
+    return m
+
+def make_data(size):
+    data = {'id': 1, 'action': {'type': 'set', 'attribute': {'power': 1}}}
+    if size > 0:
+        data['pad'] = 'x' * size
+    return data
+
+"""
+Time fn and return the number of microseconds per call. The number of calls
+is picked so each run takes about min_time seconds and the best of repeat runs
+is used.
+"""
+def measure(fn, min_time, repeat):
+    number = 1
+    while True:
+        t = timeit.timeit(fn, number=number)
+        if t >= min_time / 10:
+            break
+        number *= 10
+    number = max(1, int(number * min_time / t))
+    best = min(timeit.repeat(fn, number=number, repeat=repeat))
+    return (best / number * 1e6, number)
+
+def bench_message(version, encoding, psk, size):
+    data = make_data(size)
+    m = make_message(version, encoding, psk, data)
+    raw = m.dumps()
+    loaded = make_message(version, encoding, psk)
+    loaded.loads(raw)
+
+    def set_data():
+        make_message(version, encoding, psk).set_data(data)
+
+    def get_data():
+        loaded.get_data()
+
+    def dumps():
+        m.dumps()
+
+    def loads():
+        make_message(version, encoding, psk).loads(raw)
+
+    return [('set_data', set_data), ('get_data', get_data),
+            ('dumps', dumps), ('loads', loads)]
+
+def bench_framing(version, encoding, psk, size):
+    data = make_data(size)
+    stream = ''.join(make_message(version, encoding, psk, data).dumps()
+                     for i in range(FRAMING_MESSAGES))
+    if encoding == AVBMessage.ENC_PLAIN:
+        reader_psk = None
+    else:
+        reader_psk = psk
+
+    def framing():
+        s = StreamSocket(stream, 4096)
+        reader = AVBReader(reader_psk)
+        for i in range(FRAMING_MESSAGES):
+            reader.read_message(s)
+
+    return [('framing', framing)]
+
+def bench_response(version, encoding, psk, size):
+    data = make_data(size)
+    msg = make_message(version, encoding, psk, data)
+    writer = NullWriter()
+    if encoding == AVBMessage.ENC_PLAIN:
+        server_psk = None
+    else:
+        server_psk = psk
+
+    # avblog isn't set up here, so the logging in handle_msg stops at the level
+    # check and isn't part of the time
+    def response():
+        server.handle_msg(writer, None, msg, server_psk, None, None, None)
+
+    return [('handle_msg', response)]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--time', type=float, default=0.2, help='seconds to spend on each run')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs to take the best of')
+    parser.add_argument('--filter', help='only run benchmarks whose name contains this')
+    args = parser.parse_args()
+
+    psk = base64.b64encode(os.urandom(32))
+    results = []
+    for (version, encoding) in profiles():
+        for size in PAYLOAD_SIZES:
+            # Skip sizes that are too big for the version
+            try:
+                make_message(version, encoding, psk, make_data(size))
+            except ValueError:
+                continue
+
+            benchmarks = bench_message(version, encoding, psk, size)
+            benchmarks += bench_framing(version, encoding, psk, size)
+            benchmarks += bench_response(version, encoding, psk, size)
+            for (name, fn) in benchmarks:
+                full_name = '{:s}/v{:d}/enc{:d}/{:d}'.format(name, version, encoding, size)
+                if args.filter is not None and args.filter not in full_name:
+                    continue
+                (us, number) = measure(fn, args.time, args.repeat)
+                if name == 'framing':
+                    us /= FRAMING_MESSAGES
+                result = {'name': full_name, 'benchmark': name, 'version': version,
+                          'encoding': encoding, 'size': size, 'us_per_msg': round(us, 3),
+                          'calls': number}
+                results.append(result)
+                if not args.json:
+                    print '{:<32s} {:10.2f} us/msg'.format(full_name, us)
+
+    if args.json:
+        info = {'python': platform.python_version(),
+                'machine': platform.machine(),
+                'platform': platform.platform(),
+                'crypto': Crypto.__version__,
+                'time': args.time,
+                'repeat': args.repeat}
+        print json.dumps({'info': info, 'results': results}, indent=1)
+
+if __name__ == '__main__':
+    main()
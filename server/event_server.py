@@ -0,0 +1,386 @@
+# Event driven engine for the AVB server.
+# Instead of starting a thread for every client connection, all connections are
+# multiplexed on a single thread using select(). Sockets are non-blocking and
+# the TLS handshake is driven by the loop as data arrives. Messages are framed
+# on the loop thread and handed to a small, fixed pool of worker threads that
+# call the message handler (which talks to Vera over blocking HTTP). When a
+# worker finishes, the response is passed back to the loop which writes it to
+# the client.
+#
+# The number of worker threads stays fixed no matter how many clients are
+# connected, so a burst of connections only costs a socket and a small buffer
+# each.
+import socket, ssl
+import select
+import errno
+import threading
+import Queue
+import time
+from avbmsg import AVBMessage, AVBReader, UnsupportedVersion, version_error
+import metrics
+import avblog
+
+log = avblog.get_logger('event')
+
+# select() can't watch file descriptors numbered 1024 (FD_SETSIZE) or above.
+# Connections are capped below that, leaving room for the listening socket,
+# the wakeup pair, the connections to Vera and whatever else the server has
+# open.
+MAX_CONNECTIONS = 960
+
+# Seconds we stop accepting connections for after running out of file
+# descriptors (or memory). The clients wait in the listen backlog.
+ACCEPT_BACKOFF = 0.5
+
+# State kept for each client connection
+class Connection:
+    def __init__(self, sock, addr, handshaking, psk):
+        self.sock = sock
+        self.addr = addr
+        # True until the TLS handshake has completed
+        self.handshaking = handshaking
+        self.accepted = time.time()
+        # Set when the handshake is waiting for the socket to be writable
+        self.want_write = False
+        # Frames the messages received on the connection
+        self.reader = AVBReader(psk)
+        self.outbuf = ''
+        # Number of messages from this connection the workers are handling
+        self.in_flight = 0
+        # Set while a version 1 message is being handled. We don't frame the
+        # next message until its response has been queued so responses go out
+        # in the same order as the requests. Version 2+ messages carry a request
+        # id, so those are all handed to the workers as soon as they arrive.
+        self.ordered = False
+        # Close the connection once everything in outbuf has been sent
+        self.closing = False
+        self.last_active = time.time()
+
+class ReplyWriter:
+    """
+    Passed to the message handler in place of the client socket. The handler
+    runs on a worker thread so it must not write to the socket directly,
+    instead the data is collected and handed back to the event loop.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def sendall(self, data):
+        self.chunks.append(data)
+
+    def data(self):
+        return ''.join(self.chunks)
+
+class EventServer:
+    """
+    listen_s: a bound, listening socket
+    context: SSLContext to wrap accepted sockets in (None for no security)
+    psk: pre-shared key used to decode messages (or None)
+    handler: function(s, msg) called with a ReplyWriter and the received
+      AVBMessage. Should return False if the connection should be closed.
+    workers: number of threads used to run the handler
+    handshake_timeout: seconds a client has to complete the TLS handshake
+    idle_timeout: seconds a client may sit idle before we close it
+    max_conns: connections open at once (at most MAX_CONNECTIONS). While at
+      the limit we stop accepting, new clients wait in the listen backlog.
+    """
+    def __init__(self, listen_s, context, psk, handler, workers, handshake_timeout, idle_timeout,
+                 max_conns=MAX_CONNECTIONS):
+        self.listen_s = listen_s
+        self.context = context
+        self.psk = psk
+        self.handler = handler
+        self.workers = workers
+        self.handshake_timeout = handshake_timeout
+        self.idle_timeout = idle_timeout
+        self.max_conns = min(max_conns, MAX_CONNECTIONS)
+        # Time before which we don't accept connections (see ACCEPT_BACKOFF)
+        self.accept_after = 0
+        self.conns = {}
+        self.jobs = Queue.Queue()
+        self.done = Queue.Queue()
+        (self.wake_r, self.wake_w) = make_wakeup_pair()
+
+    def serve_forever(self):
+        self.listen_s.setblocking(0)
+
+        for i in range(self.workers):
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            t.start()
+
+        log.info('waiting for connections', extra=avblog.kv(workers=self.workers))
+        while True:
+            rlist = [self.wake_r]
+            if self.accepting():
+                rlist.append(self.listen_s)
+            wlist = []
+            for conn in self.conns.values():
+                if conn.handshaking:
+                    if conn.want_write:
+                        wlist.append(conn.sock)
+                    else:
+                        rlist.append(conn.sock)
+                    continue
+                if not conn.ordered and not conn.closing:
+                    rlist.append(conn.sock)
+                if conn.outbuf:
+                    wlist.append(conn.sock)
+
+            (r, w, x) = select.select(rlist, wlist, [], self.next_timeout())
+
+            for sock in r:
+                if sock is self.listen_s:
+                    self.accept()
+                elif sock is self.wake_r:
+                    self.finish_jobs()
+                elif sock in self.conns:
+                    conn = self.conns[sock]
+                    if conn.handshaking:
+                        self.handshake(conn)
+                    else:
+                        self.read(conn)
+
+            for sock in w:
+                if sock not in self.conns:
+                    continue
+                conn = self.conns[sock]
+                if conn.handshaking:
+                    self.handshake(conn)
+                else:
+                    self.write(conn)
+
+            self.expire_idle()
+
+    # When a connection will have been idle (or handshaking) for too long
+    def deadline(self, conn):
+        if conn.handshaking:
+            return conn.accepted + self.handshake_timeout
+        return conn.last_active + self.idle_timeout
+
+    # How long select() may block before we need to check for idle clients
+    # (or start accepting again)
+    def next_timeout(self):
+        deadlines = [self.deadline(conn) for conn in self.conns.values()]
+        if self.accept_after > time.time():
+            deadlines.append(self.accept_after)
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.time())
+
+    # True if we should take new connections
+    def accepting(self):
+        return len(self.conns) < self.max_conns and time.time() >= self.accept_after
+
+    def accept(self):
+        try:
+            (new_s, addr) = self.listen_s.accept()
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            # Running out of file descriptors or memory, or a client that gave
+            # up before we got to it, mustn't take the server down
+            if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                # The listening socket stays readable, so back off rather than
+                # spinning on it
+                self.accept_after = time.time() + ACCEPT_BACKOFF
+            log.warning('accept error', extra=avblog.kv(error=str(e)))
+            metrics.ERRORS.inc('accept')
+            return
+        log.info('connection', extra=avblog.kv(addr=addr[0], port=addr[1]))
+        metrics.CONNECTIONS_TOTAL.inc()
+
+        new_s.setblocking(0)
+        if self.context is None:
+            conn = Connection(new_s, addr, False, self.psk)
+        else:
+            # The handshake is done by the loop as the socket becomes ready
+            secure_s = self.context.wrap_socket(new_s, server_side=True,
+                                                do_handshake_on_connect=False)
+            conn = Connection(secure_s, addr, True, self.psk)
+        self.conns[conn.sock] = conn
+        metrics.CONNECTIONS.inc()
+        if len(self.conns) == self.max_conns:
+            log.warning('connection limit reached', extra=avblog.kv(max=self.max_conns))
+
+    def handshake(self, conn):
+        try:
+            conn.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            conn.want_write = False
+            return
+        except ssl.SSLWantWriteError:
+            conn.want_write = True
+            return
+        except (ssl.SSLError, socket.error) as e:
+            log.warning('handshake error', extra=avblog.kv(error=str(e)))
+            metrics.ERRORS.inc('handshake')
+            self.close(conn)
+            return
+
+        conn.handshaking = False
+        conn.want_write = False
+        conn.last_active = time.time()
+        metrics.HANDSHAKE_SECONDS.observe(conn.last_active - conn.accepted)
+        log.info('handshake done', extra=avblog.kv(
+            ms=(conn.last_active - conn.accepted) * 1000,
+            sessions_resumed=self.context.session_stats()['hits']))
+
+        # The client may have sent a message along with the end of the
+        # handshake, in which case select() won't report it as readable
+        if conn.sock.pending():
+            self.read(conn)
+
+    def read(self, conn):
+        try:
+            n = conn.reader.fill(conn.sock)
+            # SSL sockets may have more decrypted data buffered than select()
+            # knows about, so drain it now
+            while n > 0 and self.context is not None and conn.sock.pending():
+                conn.reader.fill(conn.sock)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            log.info('recv error', extra=avblog.kv(error=str(e)))
+            self.close(conn)
+            return
+
+        if n == 0:
+            log.info('connection broken or closed by client')
+            self.close(conn)
+            return
+
+        conn.last_active = time.time()
+        self.dispatch(conn)
+
+    # Hand any complete messages that are buffered to the workers
+    def dispatch(self, conn):
+        while self.dispatch_one(conn):
+            pass
+
+    # If a full message is buffered, hand it to a worker. Returns True if
+    # there may be another message we can dispatch.
+    def dispatch_one(self, conn):
+        if conn.ordered or conn.closing:
+            return False
+
+        try:
+            m = conn.reader.parse()
+        except UnsupportedVersion as e:
+            # A newer client. Tell it which versions we speak (so it can send
+            # the message again in one of them) and close the connection.
+            log.warning('unsupported protocol version', extra=avblog.kv(error=str(e)))
+            metrics.ERRORS.inc('version')
+            conn.outbuf += version_error(self.psk)
+            conn.closing = True
+            return False
+        except ValueError as e:
+            log.warning('bad message header', extra=avblog.kv(error=str(e)))
+            metrics.ERRORS.inc('header')
+            self.close(conn)
+            return False
+        if m is None:
+            return False
+
+        conn.in_flight += 1
+        if not m.has_id():
+            conn.ordered = True
+        self.jobs.put((conn, m))
+        return True
+
+    def worker(self):
+        while True:
+            (conn, m) = self.jobs.get()
+            writer = ReplyWriter()
+            try:
+                ok = self.handler(writer, m)
+            except Exception:
+                log.exception('error handling message')
+                metrics.ERRORS.inc('handler')
+                ok = False
+            self.done.put((conn, m.version, writer.data(), ok))
+            self.wake_w.send('x')
+
+    # Collect the responses produced by the workers
+    def finish_jobs(self):
+        try:
+            self.wake_r.recv(1024)
+        except socket.error:
+            pass
+
+        while True:
+            try:
+                (conn, version, data, ok) = self.done.get_nowait()
+            except Queue.Empty:
+                return
+
+            conn.in_flight -= 1
+            if version == AVBMessage.VER_1:
+                conn.ordered = False
+            if conn.sock not in self.conns:
+                # Closed while the worker was busy
+                continue
+            conn.outbuf += data
+            conn.last_active = time.time()
+            if not ok:
+                log.info('error handling message, server closing connection')
+                conn.closing = True
+                if not conn.outbuf:
+                    self.close(conn)
+                continue
+            # Another message may already be waiting
+            self.dispatch(conn)
+
+    def write(self, conn):
+        try:
+            sent = conn.sock.send(conn.outbuf)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            log.warning('send error', extra=avblog.kv(error=str(e)))
+            self.close(conn)
+            return
+
+        conn.outbuf = conn.outbuf[sent:]
+        conn.last_active = time.time()
+        if not conn.outbuf and conn.closing:
+            self.close(conn)
+
+    # Close connections that have been idle for too long. This prevents a
+    # client from opening a connection and just sitting there, consuming
+    # resources.
+    def expire_idle(self):
+        now = time.time()
+        for conn in self.conns.values():
+            if conn.in_flight == 0 and now >= self.deadline(conn):
+                log.info('connection timed out', extra=avblog.kv(addr=conn.addr[0], port=conn.addr[1]))
+                self.close(conn)
+
+    def close(self, conn):
+        # Issue a shutdown() to notify the other end that we're closing the
+        # connection, otherwise recv() on the client may wait forever
+        try:
+            conn.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        conn.sock.close()
+        if self.conns.pop(conn.sock, None) is not None:
+            metrics.CONNECTIONS.dec()
+
+# Create a connected pair of sockets used by the worker threads to wake up the
+# event loop. socket.socketpair() isn't available on Windows so we connect two
+# TCP sockets over the loopback interface instead.
+def make_wakeup_pair():
+    l = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    l.bind(('127.0.0.1', 0))
+    l.listen(1)
+    w = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    w.connect(l.getsockname())
+    (r, addr) = l.accept()
+    l.close()
+    r.setblocking(0)
+    return (r, w)
@@ -0,0 +1,330 @@
+#!/usr/bin/python
+"""
+Emulates a Vera controller, for testing the server without real hardware.
+It answers the data_request commands the server sends:
+
+  id=status    - the status document for a house full of made up devices.
+                 Supports the incremental interface (DataVersion, LoadTime,
+                 Timeout, MinimumDelay) used by the status poller, which only
+                 returns the devices that changed.
+  id=lu_action - SetTarget (on a device) and RunScene, which change the state
+                 of the devices just like the real thing
+  id=sdata     - the summary with the names of the rooms, scenes and devices
+
+The devices are a mix of switches, dimmers, sensors and thermostats, each with
+a realistic number of state variables, so the status document for a few
+thousand devices is several megabytes (like a large real installation).
+
+Responses can be delayed (with some random jitter) and a fraction of them can
+fail with an HTTP error, hang or return a broken document, to test how the
+server copes. With --churn, random devices change state in the background.
+
+Point the server at it with the [vera] section of server.cfg, e.g.
+
+[vera]
+ip=127.0.0.1
+port=3480
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+SWITCH_SID = 'urn:upnp-org:serviceId:SwitchPower1'
+DIMMER_SID = 'urn:upnp-org:serviceId:Dimming1'
+HADEVICE_SID = 'urn:micasaverde-com:serviceId:HaDevice1'
+SENSOR_SID = 'urn:micasaverde-com:serviceId:SecuritySensor1'
+TEMP_SID = 'urn:upnp-org:serviceId:TemperatureSensor1'
+HVAC_SID = 'urn:upnp-org:serviceId:HVAC_UserOperatingMode1'
+GATEWAY_SID = 'urn:micasaverde-com:serviceId:HomeAutomationGateway1'
+
+ROOMS = ['Living Room', 'Kitchen', 'Bedroom', 'Office', 'Garage', 'Hallway',
+         'Basement', 'Porch', 'Dining Room', 'Bathroom']
+KINDS = ['switch', 'switch', 'dimmer', 'dimmer', 'sensor', 'thermostat']
+SCENES = ['Good Night', 'Good Morning', 'Movie Time', 'Away', 'Dinner', 'Party',
+          'Reading', 'All Off', 'Wake Up', 'Relax']
+
+class FakeVera:
+    """
+    The state of the emulated controller.
+
+    devices/scenes: number of each to create
+    extra_states: additional filler state variables per device (real devices
+      report lots of variables the server doesn't care about)
+    delay/jitter: seconds to wait before each response, plus up to jitter more
+    error_rate/hang_rate/bad_json_rate: fraction of requests that fail with
+      HTTP 500, don't answer for hang_time seconds or return broken JSON
+    """
+    def __init__(self, devices, scenes, extra_states, delay, jitter,
+                 error_rate, hang_rate, hang_time, bad_json_rate, seed):
+        self.rnd = random.Random(seed)
+        self.delay = delay
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.hang_time = hang_time
+        self.bad_json_rate = bad_json_rate
+
+        # Everything below is protected by the lock. changed is notified when
+        # the data version goes up, to wake up long polls.
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.load_time = int(time.time())
+        self.data_version = 1
+        # Data version each device last changed at
+        self.versions = {}
+        # The full status document, cached until something changes
+        self.full_doc = None
+
+        self.devices = {}
+        for i in range(1, devices + 1):
+            self.devices[i] = self.make_device(i, extra_states)
+            self.versions[i] = self.data_version
+
+        # Each scene switches a few random devices on or off
+        self.scenes = {}
+        self.scene_names = {}
+        ids = sorted(self.devices.keys())
+        for i in range(1, scenes + 1):
+            targets = self.rnd.sample(ids, min(len(ids), self.rnd.randint(2, 8)))
+            self.scenes[i] = [(dev_id, str(self.rnd.randint(0, 1))) for dev_id in targets]
+            self.scene_names[i] = SCENES[(i - 1) % len(SCENES)]
+            if i > len(SCENES):
+                self.scene_names[i] += ' ' + str(i)
+
+    def make_device(self, i, extra_states):
+        kind = KINDS[i % len(KINDS)]
+        room = self.rnd.randint(1, len(ROOMS))
+        name = '{:s} {:s} {:d}'.format(ROOMS[room - 1], kind.capitalize(), i)
+        states = [(HADEVICE_SID, 'ConfiguredName', name),
+                  (HADEVICE_SID, 'CommFailure', '0'),
+                  (HADEVICE_SID, 'LastUpdate', str(self.load_time)),
+                  (HADEVICE_SID, 'BatteryLevel', str(self.rnd.randint(20, 100)))]
+        if kind in ('switch', 'dimmer'):
+            on = str(self.rnd.randint(0, 1))
+            states += [(SWITCH_SID, 'Status', on), (SWITCH_SID, 'Target', on)]
+        if kind == 'dimmer':
+            level = str(self.rnd.randint(0, 100))
+            states += [(DIMMER_SID, 'LoadLevelStatus', level), (DIMMER_SID, 'LoadLevelTarget', level)]
+        if kind == 'sensor':
+            states += [(SENSOR_SID, 'Armed', '1'), (SENSOR_SID, 'Tripped', '0'),
+                       (SENSOR_SID, 'LastTrip', str(self.load_time))]
+        if kind == 'thermostat':
+            states += [(TEMP_SID, 'CurrentTemperature', str(self.rnd.randint(15, 25))),
+                       (HVAC_SID, 'ModeStatus', 'HeatOn'), (SWITCH_SID, 'Status', '1')]
+        for n in range(extra_states):
+            states.append((HADEVICE_SID, 'Variable' + str(n), str(self.rnd.randint(0, 99999))))
+
+        return {'id': i, 'room': room, 'category': kind, 'status': -1, 'Jobs': [],
+                'tooltip': {'display': 0},
+                'states': [{'id': n, 'service': sid, 'variable': var, 'value': value}
+                           for (n, (sid, var, value)) in enumerate(states)]}
+
+    # Set a state variable of a device. Must be called with the lock held.
+    def set_state(self, dev_id, variable, value):
+        for state in self.devices[dev_id]['states']:
+            if state['variable'] == variable:
+                state['value'] = value
+
+    # Record that devices changed and wake up any long polls. Must be called
+    # with the lock held.
+    def bump(self, dev_ids):
+        self.data_version += 1
+        for dev_id in dev_ids:
+            self.versions[dev_id] = self.data_version
+            self.set_state(dev_id, 'LastUpdate', str(int(time.time())))
+        self.full_doc = None
+        self.changed.notify_all()
+
+    # Handle a data_request, returns the tuple (HTTP code, response body)
+    def data_request(self, params):
+        # Inject failures and latency
+        r = self.rnd.random()
+        if r < self.hang_rate:
+            time.sleep(self.hang_time)
+            return (500, 'ERROR: Timeout')
+        r -= self.hang_rate
+        if r < self.error_rate:
+            return (500, 'ERROR: Internal error')
+        r -= self.error_rate
+        bad_json = r < self.bad_json_rate
+
+        delay = self.delay + self.rnd.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        req = params.get('id')
+        if req == 'status':
+            (code, body) = (200, self.status(params))
+        elif req == 'lu_action':
+            (code, body) = self.action(params)
+        elif req == 'sdata':
+            (code, body) = (200, self.sdata())
+        else:
+            (code, body) = (400, 'ERROR: Invalid request')
+
+        if bad_json and code == 200:
+            body = body[:len(body) // 2]
+        return (code, body)
+
+    # Returns the status document. Without DataVersion this is everything,
+    # otherwise wait (up to Timeout seconds) for something to change and
+    # return just the devices that changed.
+    def status(self, params):
+        try:
+            since = int(params['DataVersion'])
+            load_time = int(params.get('LoadTime', 0))
+            timeout = float(params.get('Timeout', 60))
+            min_delay = float(params.get('MinimumDelay', 0)) / 1000
+        except (KeyError, ValueError):
+            since = None
+
+        if since is None or load_time != self.load_time:
+            return self.full_status()
+
+        # Vera waits at least MinimumDelay so changes get grouped together
+        if min_delay > 0:
+            time.sleep(min_delay)
+        deadline = time.time() + timeout
+        with self.lock:
+            while self.data_version <= since and time.time() < deadline:
+                self.changed.wait(deadline - time.time())
+            changed = [self.devices[dev_id] for (dev_id, v) in self.versions.items() if v > since]
+            return json.dumps(self.document(changed))
+
+    def full_status(self):
+        with self.lock:
+            if self.full_doc is None:
+                devices = [self.devices[dev_id] for dev_id in sorted(self.devices.keys())]
+                self.full_doc = json.dumps(self.document(devices))
+            return self.full_doc
+
+    # Build a status document with the given devices. Must be called with the
+    # lock held.
+    def document(self, devices):
+        return {'LoadTime': self.load_time, 'DataVersion': self.data_version,
+                'UserData_DataVersion': 1, 'TimeStamp': int(time.time()),
+                'Mode': 1, 'devices': devices, 'startup': {'tasks': []}}
+
+    # Returns the summary document, which is where Vera reports the names of
+    # the rooms and scenes
+    def sdata(self):
+        with self.lock:
+            devices = []
+            for dev_id in sorted(self.devices.keys()):
+                dev = self.devices[dev_id]
+                name = [s['value'] for s in dev['states'] if s['variable'] == 'ConfiguredName'][0]
+                devices.append({'id': dev_id, 'name': name, 'room': dev['room'],
+                                'category': dev['category']})
+            return json.dumps({'loadtime': self.load_time, 'dataversion': self.data_version,
+                               'rooms': [{'id': i + 1, 'name': name, 'section': 1}
+                                         for (i, name) in enumerate(ROOMS)],
+                               'scenes': [{'id': i, 'name': self.scene_names[i], 'room': 0, 'active': 0}
+                                          for i in sorted(self.scenes.keys())],
+                               'devices': devices})
+
+    # Carry out a SetTarget or RunScene action
+    def action(self, params):
+        action = params.get('action')
+        with self.lock:
+            if action == 'SetTarget':
+                try:
+                    dev_id = int(params['DeviceNum'])
+                    value = params['newTargetValue']
+                except (KeyError, ValueError):
+                    return (200, 'ERROR: Invalid Device')
+                if dev_id not in self.devices:
+                    return (200, 'ERROR: Invalid Device')
+                self.set_state(dev_id, 'Target', value)
+                self.set_state(dev_id, 'Status', value)
+                self.bump([dev_id])
+            elif action == 'RunScene':
+                try:
+                    scene = self.scenes[int(params['SceneNum'])]
+                except (KeyError, ValueError):
+                    return (200, 'ERROR: Invalid Scene')
+                for (dev_id, value) in scene:
+                    self.set_state(dev_id, 'Target', value)
+                    self.set_state(dev_id, 'Status', value)
+                self.bump([dev_id for (dev_id, value) in scene])
+            else:
+                return (200, 'ERROR: No implementation')
+            job = self.data_version
+        return (200, json.dumps({'u:' + action + 'Response': {'JobID': str(job), 'OK': 'OK'}}))
+
+    # Change random devices in the background, rate times a second
+    def churn(self, rate):
+        ids = sorted(self.devices.keys())
+        while True:
+            time.sleep(1.0 / rate)
+            with self.lock:
+                dev_id = self.rnd.choice(ids)
+                self.set_state(dev_id, 'Status', str(self.rnd.randint(0, 1)))
+                self.bump([dev_id])
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class VeraHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep-alive, like the real Vera
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != '/data_request':
+            (code, body) = (404, 'Not found')
+        else:
+            params = dict(urlparse.parse_qsl(url.query))
+            (code, body) = self.server.vera.data_request(params)
+
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Don't log every request, there are a lot of them during a load test
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=3480, help='port to listen on')
+    parser.add_argument('--devices', type=int, default=50, help='number of devices')
+    parser.add_argument('--scenes', type=int, default=10, help='number of scenes')
+    parser.add_argument('--extra-states', type=int, default=10,
+                        help='filler state variables per device')
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds to wait before each response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many more seconds of delay')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests that fail with HTTP 500')
+    parser.add_argument('--hang-rate', type=float, default=0.0,
+                        help='fraction of requests that hang for --hang-time seconds')
+    parser.add_argument('--hang-time', type=float, default=30.0, help='seconds a hung request takes')
+    parser.add_argument('--bad-json-rate', type=float, default=0.0,
+                        help='fraction of responses that are cut short')
+    parser.add_argument('--churn', type=float, default=0.0,
+                        help='random device changes per second')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the random house')
+    args = parser.parse_args()
+
+    vera = FakeVera(args.devices, args.scenes, args.extra_states, args.delay, args.jitter,
+                    args.error_rate, args.hang_rate, args.hang_time, args.bad_json_rate, args.seed)
+    httpd = ThreadedHTTPServer(('', args.port), VeraHandler)
+    httpd.vera = vera
+
+    if args.churn > 0:
+        t = threading.Thread(target=vera.churn, args=(args.churn,))
+        t.daemon = True
+        t.start()
+
+    print 'fake Vera with {:d} devices ({:d} KB status) on port {:d}'.format(
+        args.devices, len(vera.full_status()) // 1024, args.port)
+    httpd.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+#!/usr/bin/python
+"""
+Load generator for the server. A number of worker threads send a mix of
+get/set/run actions through the client code (lambda/client.py) and the time
+each request takes is recorded. At the end the throughput and latency
+percentiles are printed, along with a histogram of the latencies.
+
+To test without real hardware run the server against fake_vera.py (or with
+--no-vera), e.g.
+
+  python fake_vera.py --devices 200 --delay 0.05 &
+  python server.py --config test.cfg &
+  python load_test.py --concurrency 8 --duration 30 --mix get=8,set=1,run=1
+
+Note that you must have ../lambda and .. in your PYTHONPATH variable for this
+to work (e.g. export PYTHONPATH=../lambda:..)
+"""
+import sys
+import os
+import argparse
+import json
+import random
+import tempfile
+import threading
+import time
+import client
+
+# Upper edges (ms) of the latency histogram buckets
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+# Throws away the log output of the client code
+class NullWriter:
+    def write(self, data):
+        pass
+
+"""
+Write a client configuration file for the security profile and return its
+name. The profiles are:
+
+  none   - plain TCP (INSECURE)
+  ssl    - TLS without authentication
+  mutual - TLS with the CA and client certificate/key from certs
+  psk    - mutual plus the pre-shared key used to encrypt the message body
+"""
+def write_client_cfg(args):
+    lines = ['[server]',
+             'host=' + args.host,
+             'port=' + str(args.port),
+             'protocol=' + str(args.protocol),
+             'keep_open=yes',
+             'idle_timeout=' + str(args.idle_timeout)]
+    if args.security != 'none':
+        lines.append('[security]')
+    certs = os.path.abspath(args.certs)
+    if args.security in ('mutual', 'psk'):
+        lines.append('root_ca=' + os.path.join(certs, 'rootCA.pem'))
+        lines.append('cert=' + os.path.join(certs, 'client.crt'))
+        lines.append('key=' + os.path.join(certs, 'client.key'))
+    if args.security == 'psk':
+        lines.append('psk=' + os.path.join(certs, 'psk.bin'))
+        lines.append('psk_encoding=' + args.psk_encoding)
+
+    (fd, name) = tempfile.mkstemp(suffix='.cfg')
+    f = os.fdopen(fd, 'w')
+    f.write('\n'.join(lines) + '\n')
+    f.close()
+    return name
+
+# Parse a mix like "get=8,set=1,run=1" into a list of (action, weight)
+def parse_mix(mix):
+    weights = []
+    for item in mix.split(','):
+        (action, weight) = item.split('=')
+        if action not in ('get', 'set', 'run'):
+            raise ValueError('unknown action ' + action)
+        weights.append((action, float(weight)))
+    return weights
+
+def pick_action(weights, rnd):
+    r = rnd.uniform(0, sum(w for (a, w) in weights))
+    for (action, weight) in weights:
+        r -= weight
+        if r <= 0:
+            return action
+    return weights[-1][0]
+
+def make_request(action, devices, scenes, rnd):
+    if action == 'get':
+        return {'id': rnd.randint(1, devices), 'action': {'type': 'get'}}
+    elif action == 'set':
+        return {'id': rnd.randint(1, devices),
+                'action': {'type': 'set', 'attribute': {'power': rnd.randint(0, 1)}}}
+    return {'id': rnd.randint(1, scenes), 'action': {'type': 'run'}}
+
+class Worker(threading.Thread):
+    """
+    Sends requests until the deadline (or its share of the requests) is
+    reached. Each worker has its own connection to the server, which is
+    replaced after every per_connection requests (0 to keep it for the whole
+    run).
+    """
+    def __init__(self, i, cfg_file, args, weights, deadline, count):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.cfg_file = cfg_file
+        self.args = args
+        self.weights = weights
+        self.deadline = deadline
+        self.count = count
+        self.rnd = random.Random(i)
+        # (action, latency in seconds, status) for each request
+        self.results = []
+
+    def run(self):
+        conn = client.VeraConnection(self.cfg_file)
+        sent = 0
+        while time.time() < self.deadline and (self.count is None or sent < self.count):
+            action = pick_action(self.weights, self.rnd)
+            data = make_request(action, self.args.devices, self.args.scenes, self.rnd)
+            start = time.time()
+            try:
+                resp = conn.request(data)
+                status = resp['status']
+            except Exception:
+                conn.disconnect()
+                status = 'error'
+            self.results.append((action, time.time() - start, status))
+            sent += 1
+
+            if self.args.per_connection > 0 and sent % self.args.per_connection == 0:
+                conn.disconnect()
+        conn.disconnect()
+
+# Return the p-th percentile (0-100) of a sorted list
+def percentile(values, p):
+    if not values:
+        return 0.0
+    i = int(round(p / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(i, len(values) - 1))]
+
+def summarize(results, elapsed):
+    latencies = sorted(r[1] * 1000 for r in results)
+    statuses = {}
+    actions = {}
+    for (action, latency, status) in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        actions[action] = actions.get(action, 0) + 1
+
+    histogram = []
+    lower = 0
+    for upper in BUCKETS + [None]:
+        if upper is None:
+            n = len([l for l in latencies if l >= lower])
+        else:
+            n = len([l for l in latencies if lower <= l < upper])
+        histogram.append({'lower_ms': lower, 'upper_ms': upper, 'count': n})
+        lower = upper
+
+    return {'requests': len(results),
+            'elapsed_s': round(elapsed, 3),
+            'throughput_rps': round(len(results) / elapsed, 1) if elapsed > 0 else 0.0,
+            'mean_ms': round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'max_ms': round(latencies[-1], 3) if latencies else 0.0,
+            'actions': actions,
+            'statuses': statuses,
+            'histogram': histogram}
+
+def print_summary(s):
+    print 'requests:   {:d} in {:.1f}s ({:.1f} req/s)'.format(s['requests'], s['elapsed_s'], s['throughput_rps'])
+    print 'actions:    ' + ', '.join('{:s}={:d}'.format(a, n) for (a, n) in sorted(s['actions'].items()))
+    print 'statuses:   ' + ', '.join('{:s}={:d}'.format(a, n) for (a, n) in sorted(s['statuses'].items()))
+    print 'latency ms: mean {:.2f}  p50 {:.2f}  p95 {:.2f}  p99 {:.2f}  max {:.2f}'.format(
+        s['mean_ms'], s['p50_ms'], s['p95_ms'], s['p99_ms'], s['max_ms'])
+    print
+    top = max([b['count'] for b in s['histogram']] + [1])
+    for b in s['histogram']:
+        if b['upper_ms'] is None:
+            label = '>= {:d} ms'.format(b['lower_ms'])
+        else:
+            label = '< {:d} ms'.format(b['upper_ms'])
+        print '{:>11s} {:7d} {:s}'.format(label, b['count'], '#' * int(50.0 * b['count'] / top))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='localhost', help='server host')
+    parser.add_argument('--port', type=int, default=3000, help='server port')
+    parser.add_argument('--protocol', type=int, default=1, choices=[1, 2, 3], help='AVB protocol version')
+    parser.add_argument('--security', default='none', choices=['none', 'ssl', 'mutual', 'psk'],
+                        help='security profile (must match the server)')
+    parser.add_argument('--certs', default='../security/sample', help='directory with the client certs and psk')
+    parser.add_argument('--psk-encoding', default='aes-cbc', choices=['aes-cbc', 'chacha20-poly1305'],
+                        help='cipher used with the psk')
+    parser.add_argument('--concurrency', type=int, default=4, help='number of worker threads')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds to run for')
+    parser.add_argument('--requests', type=int, help='stop after this many requests (in total)')
+    parser.add_argument('--mix', default='get=8,set=1,run=1', help='weights of each action type')
+    parser.add_argument('--devices', type=int, default=50, help='device ids are picked from 1..devices')
+    parser.add_argument('--scenes', type=int, default=5, help='scene ids are picked from 1..scenes')
+    parser.add_argument('--per-connection', type=int, default=0,
+                        help='requests sent on a connection before it is replaced (0 to keep it open)')
+    parser.add_argument('--idle-timeout', type=float, default=4.5, help='client idle_timeout')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    weights = parse_mix(args.mix)
+    cfg_file = write_client_cfg(args)
+
+    count = None
+    if args.requests is not None:
+        count = (args.requests + args.concurrency - 1) // args.concurrency
+
+    # The client code logs every message, keep that out of the results
+    stdout = sys.stdout
+    sys.stdout = NullWriter()
+    try:
+        start = time.time()
+        workers = [Worker(i, cfg_file, args, weights, start + args.duration, count)
+                   for i in range(args.concurrency)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        elapsed = time.time() - start
+    finally:
+        sys.stdout = stdout
+        os.remove(cfg_file)
+
+    results = []
+    for w in workers:
+        results += w.results
+    summary = summarize(results, elapsed)
+    summary['config'] = {'concurrency': args.concurrency, 'protocol': args.protocol,
+                         'security': args.security, 'mix': args.mix,
+                         'per_connection': args.per_connection}
+    if args.json:
+        print json.dumps(summary, indent=1)
+    else:
+        print_summary(summary)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+# Metrics for the AVB server, served over HTTP in the Prometheus text format
+# (e.g. http://pi:9100/metrics) when metrics_port is set in server.cfg.
+#
+# Metrics are always collected. Updating one is a lock and an addition, so it
+# costs next to nothing compared with handling a message. The listener is
+# plain HTTP without authentication, it only exposes counts and timings.
+import threading
+import BaseHTTPServer
+import SocketServer
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# All the metrics, in the order they are exported
+registry = []
+
+class Metric:
+    """
+    Base for the metric types. labels is the list of label names, each update
+    passes the values for them (in the same order).
+    """
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        # Label values (tuple) -> value
+        self.values = {}
+        registry.append(self)
+
+    def label_str(self, values, extra=None):
+        pairs = ['{:s}="{:s}"'.format(name, str(value))
+                 for (name, value) in zip(self.labels, values)]
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(pairs) + '}'
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return ['{:s}{:s} {:s}'.format(self.name, self.label_str(k), repr(float(v)))
+                for (k, v) in items]
+
+    def export(self):
+        lines = ['# HELP {:s} {:s}'.format(self.name, self.help),
+                 '# TYPE {:s} {:s}'.format(self.name, self.kind)]
+        return lines + self.samples()
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + 1
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. If fn is given it is called to read the
+    value when the metrics are exported (for things like the thread count).
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), fn=None):
+        Metric.__init__(self, name, help, labels)
+        self.fn = fn
+
+    def inc(self, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + 1
+
+    def dec(self, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) - 1
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def samples(self):
+        if self.fn is not None:
+            self.set(self.fn())
+        return Metric.samples(self)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def observe(self, value, *labels):
+        with self.lock:
+            h = self.values.get(labels)
+            if h is None:
+                # Count per bucket, sum, count
+                h = self.values[labels] = [[0] * len(BUCKETS), 0.0, 0]
+            for (i, bound) in enumerate(BUCKETS):
+                if value <= bound:
+                    h[0][i] += 1
+                    break
+            h[1] += value
+            h[2] += 1
+
+    def samples(self):
+        with self.lock:
+            items = sorted((k, ([n for n in h[0]], h[1], h[2])) for (k, h) in self.values.items())
+        lines = []
+        for (k, (buckets, total, count)) in items:
+            cumulative = 0
+            for (bound, n) in zip(BUCKETS, buckets):
+                cumulative += n
+                lines.append('{:s}_bucket{:s} {:d}'.format(
+                    self.name, self.label_str(k, 'le="{:s}"'.format(repr(bound))), cumulative))
+            lines.append('{:s}_bucket{:s} {:d}'.format(
+                self.name, self.label_str(k, 'le="+Inf"'), count))
+            lines.append('{:s}_sum{:s} {:s}'.format(self.name, self.label_str(k), repr(total)))
+            lines.append('{:s}_count{:s} {:d}'.format(self.name, self.label_str(k), count))
+        return lines
+
+# The metrics of the server
+REQUESTS = Counter('avb_requests_total', 'Messages handled, by action type', ('action',))
+REQUEST_SECONDS = Histogram('avb_request_seconds', 'Time to handle a message, by action type', ('action',))
+RESPONSES = Counter('avb_responses_total', 'Responses sent, by status code', ('status',))
+DECODE_SECONDS = Histogram('avb_decode_seconds', 'Time to decrypt and parse a message body')
+ERRORS = Counter('avb_errors_total', 'Errors, by type', ('type',))
+VERA_SECONDS = Histogram('vera_request_seconds', 'Time taken by Vera to answer, by request id', ('request',))
+VERA_RESPONSES = Counter('vera_responses_total', 'Responses from Vera, by HTTP status code', ('code',))
+COALESCED = Counter('avb_coalesced_total', 'Commands not sent to Vera because an identical one was in flight or had just succeeded', ('how',))
+STATE_WRITES = Counter('avb_state_writes_total', 'Optimistic device state updates, by how they ended', ('outcome',))
+HANDSHAKE_SECONDS = Histogram('tls_handshake_seconds', 'Time to complete the TLS handshake')
+CONNECTIONS = Gauge('avb_connections', 'Client connections currently open')
+CONNECTIONS_TOTAL = Counter('avb_connections_total', 'Client connections accepted')
+THREADS = Gauge('avb_threads', 'Threads running in the server', fn=threading.active_count)
+
+# Return all the metrics in the Prometheus text format
+def export():
+    lines = []
+    for metric in registry:
+        lines += metric.export()
+    return '\n'.join(lines) + '\n'
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = export()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Don't log every scrape
+    def log_message(self, format, *args):
+        pass
+
+# Serve /metrics on port in a background thread
+def start_server(port):
+    httpd = ThreadedHTTPServer(('', port), MetricsHandler)
+    t = threading.Thread(target=httpd.serve_forever)
+    t.daemon = True
+    t.start()
+    return httpd
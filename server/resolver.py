@@ -0,0 +1,264 @@
+# Resolves spoken names ("the bedroom light", "movie time") to Vera device and
+# scene ids, so a client can act on a device without knowing its number.
+#
+# Names are normalized (lower case, punctuation dropped, number words turned
+# into digits, "the"/"my" dropped, plurals folded) and split into tokens. A
+# device is found by the tokens of its own name plus the tokens of the name of
+# its room, so "bedroom light" finds the device "Light" in the room "Bedroom"
+# as well as a device called "Bedroom Light". Each token is also indexed by
+# its Soundex key, and words that don't match any token exactly are compared
+# against all the known tokens with difflib, so names Alexa heard slightly
+# wrong ("kitchin", "dinning room") still resolve.
+#
+# The index is kept up to date from the status documents the StatusCache
+# already fetches. Only the devices whose name or room changed are reindexed,
+# so keeping it current costs almost nothing. Room and scene names aren't in
+# the status document, they come from Vera's sdata request.
+import re
+import difflib
+import threading
+
+KIND_DEVICE = 'device'
+KIND_SCENE = 'scene'
+
+# Words that carry no meaning in a device name
+STOPWORDS = set(['the', 'a', 'an', 'my', 'our', 'please', 'in', 'of'])
+
+NUMBERS = {'zero': '0', 'one': '1', 'two': '2', 'three': '3', 'four': '4',
+           'five': '5', 'six': '6', 'seven': '7', 'eight': '8', 'nine': '9',
+           'ten': '10', 'eleven': '11', 'twelve': '12', 'thirteen': '13',
+           'fourteen': '14', 'fifteen': '15', 'sixteen': '16', 'seventeen': '17',
+           'eighteen': '18', 'nineteen': '19', 'twenty': '20',
+           'first': '1', 'second': '2', 'third': '3'}
+
+# Weight of a token matched exactly, by its sound and by spelling
+EXACT = 1.0
+PHONETIC = 0.8
+FUZZY = 0.7
+
+# Closest spelling (difflib ratio) that counts as a fuzzy match
+FUZZY_CUTOFF = 0.8
+
+# Most matches returned by resolve()
+MAX_MATCHES = 5
+
+def tokenize(name):
+    tokens = []
+    for word in re.split(r'[^a-z0-9]+', name.lower()):
+        if word == '' or word in STOPWORDS:
+            continue
+        word = NUMBERS.get(word, word)
+        # Fold simple plurals ("lights" -> "light")
+        if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+SOUNDEX_CODES = {}
+for (letters, code) in (('bfpv', '1'), ('cgjkqsxz', '2'), ('dt', '3'),
+                        ('l', '4'), ('mn', '5'), ('r', '6')):
+    for c in letters:
+        SOUNDEX_CODES[c] = code
+
+# The Soundex key of a word (e.g. "kitchen" and "kitchin" are both K325).
+# Numbers have no sound key, they have to match exactly.
+def soundex(word):
+    if not word.isalpha():
+        return None
+    key = word[0].upper()
+    last = SOUNDEX_CODES.get(word[0])
+    for c in word[1:]:
+        code = SOUNDEX_CODES.get(c)
+        if code is not None and code != last:
+            key += code
+        # h and w don't separate letters with the same code, vowels do
+        if c not in 'hw':
+            last = code
+    return (key + '000')[:4]
+
+class Entry:
+    def __init__(self, kind, obj_id, name, room):
+        self.kind = kind
+        self.id = obj_id
+        self.name = name
+        self.room = room
+        self.tokens = set(tokenize(name))
+
+class NameResolver:
+    """
+    Index of device and scene names. All the methods are thread safe, lookups
+    run on the client threads while the cache and poller update the index.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (kind, id) -> Entry
+        self.entries = {}
+        # Room id -> set of the tokens of its name
+        self.rooms = {}
+        # Token -> set of (kind, id) whose name or room has the token, and the
+        # same by the Soundex key of the token
+        self.by_token = {}
+        self.by_sound = {}
+        # Set once the room and scene names have been loaded
+        self.have_sdata = False
+
+    # The tokens a device or scene can be found by
+    def search_tokens(self, entry):
+        return entry.tokens | self.rooms.get(entry.room, set())
+
+    def add(self, entry):
+        key = (entry.kind, entry.id)
+        self.entries[key] = entry
+        for token in self.search_tokens(entry):
+            self.by_token.setdefault(token, set()).add(key)
+            sound = soundex(token)
+            if sound is not None:
+                self.by_sound.setdefault(sound, set()).add(key)
+
+    def remove(self, kind, obj_id):
+        entry = self.entries.pop((kind, obj_id), None)
+        if entry is None:
+            return
+        for token in self.search_tokens(entry):
+            discard(self.by_token, token, (kind, obj_id))
+            sound = soundex(token)
+            if sound is not None:
+                discard(self.by_sound, sound, (kind, obj_id))
+
+    # Rebuild the token indexes from the entries (after the rooms change)
+    def reindex(self):
+        entries = self.entries.values()
+        self.entries = {}
+        self.by_token = {}
+        self.by_sound = {}
+        for entry in entries:
+            self.add(entry)
+
+    # Update the devices from the devices list of a Vera status document. A
+    # full document replaces all the devices, otherwise only the devices in the
+    # list are updated.
+    def update_devices(self, devices, full):
+        with self.lock:
+            seen = set()
+            for dev in devices:
+                if 'id' not in dev:
+                    continue
+                seen.add(dev['id'])
+                name = device_name(dev)
+                old = self.entries.get((KIND_DEVICE, dev['id']))
+                if name is None:
+                    if old is None:
+                        continue
+                    # Incremental documents only carry the variables that
+                    # changed, keep the name we have
+                    name = old.name
+                room = dev.get('room', old.room if old is not None else None)
+                # Most of the time nothing about the name has changed
+                if old is not None and old.name == name and old.room == room:
+                    continue
+                self.remove(KIND_DEVICE, dev['id'])
+                self.add(Entry(KIND_DEVICE, dev['id'], name, room))
+
+            # Devices missing from a full document have been removed
+            if full:
+                for (kind, obj_id) in self.entries.keys():
+                    if kind == KIND_DEVICE and obj_id not in seen:
+                        self.remove(kind, obj_id)
+
+    # Load the rooms and scenes from a Vera sdata document. Its device list
+    # also has the room of every device, which some status documents lack.
+    # Anything whose name isn't a string is skipped.
+    def update_sdata(self, sdata):
+        with self.lock:
+            for dev in sdata.get('devices', []):
+                old = self.entries.get((KIND_DEVICE, dev.get('id')))
+                name = dev.get('name', old.name if old is not None else None)
+                if not isinstance(name, basestring):
+                    continue
+                room = dev.get('room', old.room if old is not None else None)
+                self.entries[(KIND_DEVICE, dev['id'])] = Entry(KIND_DEVICE, dev['id'], name, room)
+            for key in [k for k in self.entries if k[0] == KIND_SCENE]:
+                del self.entries[key]
+            for scene in sdata.get('scenes', []):
+                if not isinstance(scene.get('name'), basestring):
+                    continue
+                entry = Entry(KIND_SCENE, scene['id'], scene['name'], scene.get('room'))
+                self.entries[(KIND_SCENE, entry.id)] = entry
+            self.rooms = {}
+            for room in sdata.get('rooms', []):
+                if not isinstance(room.get('name'), basestring):
+                    continue
+                self.rooms[room['id']] = set(tokenize(room['name']))
+            # The rooms are part of the search tokens of every device
+            self.reindex()
+            self.have_sdata = True
+
+    # Find the devices (or scenes) whose name best matches name. Returns a list
+    # of dicts with the id, name and score (0-1) of each match, best first.
+    # Every word of name has to match the device name or its room.
+    def resolve(self, name, kind=KIND_DEVICE):
+        query = tokenize(name)
+        if not query:
+            return []
+
+        with self.lock:
+            # How each word of the query can match: a set of candidate keys
+            # for each weight
+            matches = []
+            for token in query:
+                exact = self.by_token.get(token, set())
+                m = [(EXACT, exact)]
+                sound = soundex(token)
+                if sound is not None:
+                    m.append((PHONETIC, self.by_sound.get(sound, set())))
+                    if not exact:
+                        fuzzy = set()
+                        for t in difflib.get_close_matches(token, self.by_token.keys(), 3, FUZZY_CUTOFF):
+                            fuzzy |= self.by_token[t]
+                        m.append((FUZZY, fuzzy))
+                matches.append(m)
+
+            # Only the entries that every word matches one way or another
+            candidates = None
+            for m in matches:
+                keys = set()
+                for (weight, found) in m:
+                    keys |= found
+                keys = set(k for k in keys if k[0] == kind)
+                candidates = keys if candidates is None else candidates & keys
+
+            results = []
+            for key in candidates:
+                entry = self.entries[key]
+                score = sum(max(w for (w, found) in m if key in found) for m in matches) / len(query)
+                # Prefer names that the query covers completely ("kitchen
+                # switch" over "kitchen switch dimmer")
+                if entry.tokens:
+                    covered = len(entry.tokens & set(query)) / float(len(entry.tokens))
+                    score *= 0.5 + 0.5 * covered
+                results.append({'id': entry.id, 'name': entry.name, 'score': round(score, 3)})
+
+        results.sort(key=lambda r: (-r['score'], r['id']))
+        return results[:MAX_MATCHES]
+
+def discard(index, token, key):
+    keys = index.get(token)
+    if keys is not None:
+        keys.discard(key)
+        if not keys:
+            del index[token]
+
+# The name of a device in a status document (None if it isn't there, or isn't
+# a string)
+def device_name(dev):
+    name = None
+    if 'name' in dev:
+        name = dev['name']
+    else:
+        for state in dev.get('states', []):
+            if state.get('variable') == 'ConfiguredName':
+                name = state.get('value')
+                break
+    if not isinstance(name, basestring):
+        return None
+    return name
@@ -6,20 +6,43 @@ import requests
 import ConfigParser
 import argparse
 import threading
-from avbmsg import AVBMessage
+import Queue
+import time
+from avbmsg import AVBMessage, AVBReader, UnsupportedVersion, version_error, FORMAT_ERROR
+import event_server
+from event_server import EventServer
+import metrics
+import avblog
+import avbtrace
+from resolver import NameResolver, KIND_DEVICE, KIND_SCENE
+from multiprocessing.pool import ThreadPool
+
+# Largest number of actions we accept in one batch message
+MAX_BATCH_SIZE = 50
+
+# Turned away connections waiting for their "server busy" response. Past this
+# they are closed without one.
+BUSY_QUEUE_SIZE = 32
+
+log = avblog.get_logger('server')
 
 """
 This is the underlying data format that AVBMessage wraps in a header
 and optionally encrypts. The various fields are as follows:
 
 id: The numeric device id we want to interact with
+name: Instead of the id, the spoken name of the device or scene (e.g.
+  "bedroom light", "movie time"). The server looks it up in its index of the
+  device, room and scene names, allowing for small mistakes in the name.
 action: A block that specifies the type of action and attribute data
   (only used for "set" action type)
 
-  type: Type of action, currently support get/set/run
+  type: Type of action, currently support get/set/run/resolve
     - "get" - returns information about the device
     - "set" - sets the specified attributes to the specified values
     - "run" - only applies to scenes
+    - "resolve" - returns the devices (or scenes, if "kind" is "scene") that
+      best match name, as a list of { "id", "name", "score" }
   attribute: The only valid attribute is "power" for on/off type devices
 
 JSON message format example (Client->Server):
@@ -35,10 +58,17 @@ JSON message format example (Client->Server):
     }
 }
 
-status: 0 indicates success, 1 an error, 2 simulated mode
+status: 0 indicates success, 1 an error, 2 simulated mode, 3 server busy
 err_str: a string indicating what failed that Alexa will dictate
 id: the device id
-data: data returned for a "get" action type
+data: data returned for a "get" action type. It has "pending": true if the
+  status is one a "set" just asked for and Vera hasn't confirmed yet.
+
+A name that matches nothing gets status 1 with err_str "unknown name". If
+several devices match equally well the status is 1, err_str is "ambiguous
+name" and data has the matches so the client can ask which one was meant.
+Otherwise the response data includes the id (and for "set" and "run" the
+name) of the device the name was resolved to.
 
 JSON message format example (Server->Client):
 {
@@ -51,32 +81,647 @@ JSON message format example (Server->Client):
         "name": "Bedroom Outlet"
     }
 }
+
+Several actions can be sent in one message as a batch. The server runs them
+all (in parallel) and returns one response whose data is the list of
+responses for the individual actions, in the same order. The status is 0 if
+every action succeeded and 1 (with err_str saying how many failed) otherwise.
+
+JSON batch message format example (Client->Server):
+{
+    "batch":
+    [
+        { "id": 1, "action": { "type": "set", "attribute": { "power": 0 } } },
+        { "id": 2, "action": { "type": "set", "attribute": { "power": 0 } } }
+    ]
+}
+
+JSON batch response format example (Server->Client):
+{
+    "status": 0,
+    "err_str": null,
+    "data":
+    [
+        { "status": 0, "err_str": null, "data": null },
+        { "status": 0, "err_str": null, "data": null }
+    ]
+}
 """
 
-def handle_msg(s, vera_ip, vera_port, msg, psk):
-    print 'got msg: ' + msg.dumps()
+# Raised when a request to Vera fails. The message is passed back to the client
+# as the err_str of the response.
+class VeraError(Exception):
+    pass
+
+class VeraClient:
+    """
+    Sends data_request commands to Vera over a shared requests.Session. The
+    session keeps a pool of up to pool_size keep-alive connections so bursts
+    of commands reuse an open TCP connection instead of connecting to Vera for
+    every message.
+
+    At most max_calls requests are sent to Vera at once, any others wait for
+    one of them to finish. The status poller's request doesn't count against
+    max_calls, so the pool holds at least max_calls + 1 connections, any
+    fewer and urllib3 would close the extra connections after each burst.
+
+    The session is shared by all client threads (and the status poller).
+    """
+    def __init__(self, ip, port, pool_size, max_calls, connect_timeout, read_timeout):
+        self.dest = 'http://' + ip + ':' + str(port) + '/data_request'
+        self.timeout = (connect_timeout, read_timeout)
+        self.calls = threading.BoundedSemaphore(max_calls)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=max(pool_size, max_calls + 1))
+        self.session.mount('http://', adapter)
+
+    # Issue a data_request with the given params and return the response.
+    # Raises VeraError if the request fails or Vera returns a non-200 code.
+    # The read timeout can be overridden (e.g. for long polls). Set limit to
+    # False for requests that shouldn't count against max_calls (the status
+    # poller holds its request open for a long time).
+    def request(self, params, read_timeout=None, limit=True):
+        timeout = self.timeout
+        if read_timeout is not None:
+            timeout = (self.timeout[0], read_timeout)
+
+        if limit:
+            with avbtrace.span('vera_wait'):
+                self.calls.acquire()
+        start = time.time()
+        try:
+            with avbtrace.span('vera', request=params.get('id')):
+                r = self.session.get(self.dest, params=params, timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            log.warning('Vera request failed', extra=avblog.kv(
+                request=params.get('id'), error=str(e), ms=(time.time() - start) * 1000))
+            metrics.VERA_RESPONSES.inc('error')
+            raise VeraError('requests exception')
+        finally:
+            metrics.VERA_SECONDS.observe(time.time() - start, params.get('id'))
+            if limit:
+                self.calls.release()
+
+        metrics.VERA_RESPONSES.inc(r.status_code)
+        if r.status_code != 200:
+            log.warning('non-200 response from Vera', extra=avblog.kv(
+                request=params.get('id'), code=r.status_code))
+            raise VeraError('bad response from Vera')
+        return r
+
+class Command:
+    def __init__(self, value):
+        self.value = value
+        # Set once Vera has answered
+        self.event = threading.Event()
+        self.done = None
+        self.error = None
+
+class CommandCoalescer:
+    """
+    Collapses repeated "set" and "run" commands into one request to Vera.
+    Alexa retries and users repeating themselves send the same command for
+    the same device several times within a few milliseconds.
+
+    Commands are keyed on (action, id) and carry their value (the power for
+    "set", None for "run"). A command that is the same as one already in
+    flight waits for that one and shares its result. One that is the same
+    as a command that succeeded less than window seconds ago is answered
+    straight away. A command with a different value always goes to Vera and
+    replaces the last command for the key, so "on", "off", "on" is never
+    collapsed into "on".
+    """
+    # Prune finished commands once we hold more than this many
+    MAX_COMMANDS = 1000
+
+    def __init__(self, window):
+        self.window = window
+        self.lock = threading.Lock()
+        # (action, id) -> the last Command sent for it
+        self.commands = {}
+
+    # Send a command to Vera by calling fn(), unless an identical command is
+    # in flight or has just succeeded. Raises whatever fn() raised (VeraError
+    # if Vera failed) if the request, ours or the one we joined, failed.
+    def run(self, action, obj_id, value, fn):
+        key = (action, obj_id)
+        with self.lock:
+            cmd = self.commands.get(key)
+            if cmd is not None and cmd.value == value and (cmd.done is None or
+                    (cmd.error is None and time.time() - cmd.done < self.window)):
+                leader = False
+            else:
+                if len(self.commands) >= self.MAX_COMMANDS:
+                    self.prune()
+                cmd = self.commands[key] = Command(value)
+                leader = True
+
+        if not leader:
+            if cmd.done is None:
+                metrics.COALESCED.inc('in_flight')
+                with avbtrace.span('coalesced'):
+                    cmd.event.wait()
+            else:
+                metrics.COALESCED.inc('recent')
+            if cmd.error is not None:
+                raise cmd.error
+            return
+
+        # Any error is kept for the waiters, so none of them (or anyone
+        # coming within window) takes a failed command as done
+        try:
+            fn()
+        except Exception as e:
+            cmd.error = e
+            raise
+        finally:
+            with self.lock:
+                cmd.done = time.time()
+            cmd.event.set()
+
+    # Forget the commands that finished longer than window ago. Call with the
+    # lock held.
+    def prune(self):
+        now = time.time()
+        for (key, cmd) in self.commands.items():
+            if cmd.done is not None and now - cmd.done >= self.window:
+                del self.commands[key]
+
+class StatusCache:
+    """
+    Holds a snapshot of the Vera /status document so that "get" actions don't
+    need a full HTTP round trip and a scan of every device. The snapshot is
+    indexed by device id and then by state variable, e.g.
+
+    devices[1]['Status'] -> '1'
+    devices[1]['ConfiguredName'] -> 'Bedroom Outlet'
+
+    The snapshot is refreshed when it is older than ttl seconds. If several
+    threads find the snapshot stale at the same time only one of them talks to
+    Vera, the others wait for that refresh to finish and share its result.
+
+    Every status document that comes in also updates the name index (names),
+    so actions can refer to devices and scenes by name.
+
+    When a "set" succeeds the new value is written to the snapshot straight
+    away (write()) so a "get" right after it is answered from memory with the
+    value the user asked for. Vera takes a moment to report the new state, so
+    until it does (or confirm_timeout seconds pass) the written value is
+    pending and takes precedence over the value in the status documents.
+    """
+    def __init__(self, vera, ttl, confirm_timeout):
+        self.vera = vera
+        self.ttl = ttl
+        self.confirm_timeout = confirm_timeout
+        self.devices = {}
+        self.timestamp = None
+        self.lock = threading.Lock()
+        # Event for the refresh currently in flight (None if there isn't one)
+        self.pending = None
+        self.error = None
+        # Set while a StatusPoller is keeping the snapshot up to date
+        self.live = False
+        self.names = NameResolver()
+        # LoadTime of the Vera that the room and scene names came from
+        self.names_load_time = None
+        # Pending writes, (device id, variable) -> (value, previous value,
+        # time we stop waiting for Vera to confirm it)
+        self.writes = {}
+
+    # Returns the dict of state variables for the device, or None if Vera
+    # doesn't know about the device. Raises VeraError if the refresh fails.
+    def get_device(self, dev_id):
+        self.refresh()
+        with self.lock:
+            if self.writes:
+                self.settle_writes({})
+            return self.devices.get(dev_id)
+
+    # Record that we told Vera to set a state variable of the device to value
+    def write(self, dev_id, variable, value):
+        with self.lock:
+            states = self.devices.get(dev_id)
+            previous = None
+            if (dev_id, variable) in self.writes:
+                # Still the last value Vera reported
+                previous = self.writes[(dev_id, variable)][1]
+            elif states is not None:
+                previous = states.get(variable)
+            if states is not None:
+                states[variable] = value
+            self.writes[(dev_id, variable)] = (value, previous, time.time() + self.confirm_timeout)
+
+    # True if the value of the variable is one we wrote and Vera hasn't
+    # reported yet
+    def is_pending(self, dev_id, variable):
+        with self.lock:
+            return (dev_id, variable) in self.writes
+
+    # Reconcile the pending writes with the states Vera just reported (an index
+    # from index_devices(), already merged into the snapshot). Call with the
+    # lock held. A write is confirmed once Vera reports the same value. Until
+    # then it overrides what Vera reports, unless it has been waiting for more
+    # than confirm_timeout, in which case we go with Vera.
+    def settle_writes(self, reported):
+        now = time.time()
+        for ((dev_id, variable), (value, previous, expires)) in self.writes.items():
+            r = reported.get(dev_id, {}).get(variable)
+            states = self.devices.get(dev_id)
+            if r == value:
+                del self.writes[(dev_id, variable)]
+                metrics.STATE_WRITES.inc('confirmed')
+            elif now >= expires:
+                del self.writes[(dev_id, variable)]
+                metrics.STATE_WRITES.inc('expired')
+                log.warning('Vera did not confirm device state',
+                            extra=avblog.kv(device=dev_id, variable=variable, value=value, vera=r))
+                # Put back what Vera last told us, if it hasn't told us since
+                if r is None and states is not None and previous is not None:
+                    states[variable] = previous
+            elif states is not None:
+                states[variable] = value
+
+    # Mark the snapshot as stale so the next lookup goes back to Vera
+    def invalidate(self):
+        with self.lock:
+            self.timestamp = None
+
+    def is_fresh(self):
+        if self.live:
+            return True
+        return self.timestamp is not None and time.time() - self.timestamp < self.ttl
+
+    # Refresh the snapshot if it is stale, joining a refresh that is already
+    # in progress rather than starting a new one
+    def refresh(self):
+        with self.lock:
+            if self.is_fresh():
+                return
+            if self.pending is not None:
+                event = self.pending
+                leader = False
+            else:
+                event = self.pending = threading.Event()
+                self.error = None
+                leader = True
+
+        if not leader:
+            event.wait()
+            if self.error is not None:
+                raise self.error
+            return
+
+        # Whatever happens the waiters have to be woken up (with the error if
+        # there was one), or every lookup after this would wait forever
+        try:
+            devices = self.fetch()
+            with self.lock:
+                self.devices = devices
+                if self.writes:
+                    self.settle_writes(devices)
+                self.timestamp = time.time()
+        except Exception as e:
+            with self.lock:
+                self.error = e
+            raise
+        finally:
+            with self.lock:
+                self.pending = None
+            event.set()
+
+    # Request the full status from Vera and build the index. Raises VeraError
+    # if the request fails or the document isn't what we expect.
+    def fetch(self):
+        r = self.vera.request({'id':'status'})
+        try:
+            with avbtrace.span('status_parse'):
+                status = r.json()
+                devices = index_devices(status)
+            self.update_names(status, True)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise VeraError('bad status from Vera')
+        return devices
+
+    # Merge a status document from the poller into the snapshot. A full
+    # document replaces the snapshot, otherwise only the devices and state
+    # variables that Vera reported as changed are updated.
+    def merge(self, status, full):
+        devices = index_devices(status)
+        self.update_names(status, full)
+        with self.lock:
+            if full:
+                self.devices = devices
+            else:
+                for (dev_id, states) in devices.items():
+                    self.devices.setdefault(dev_id, {}).update(states)
+            if self.writes:
+                self.settle_writes(devices)
+            self.timestamp = time.time()
+            self.live = True
+
+    # Update the name index from a status document. The room and scene names
+    # are (re)loaded the first time and whenever Vera has restarted, which is
+    # when they can have changed.
+    def update_names(self, status, full):
+        self.names.update_devices(status.get('devices', []), full)
+        if full and (not self.names.have_sdata or status.get('LoadTime') != self.names_load_time):
+            self.names_load_time = status.get('LoadTime')
+            self.load_sdata()
+
+    # Load the room and scene names. Device names still resolve without them,
+    # so a failure is only logged (and retried on the next lookup).
+    def load_sdata(self):
+        try:
+            self.names.update_sdata(self.vera.request({'id':'sdata'}).json())
+        except (VeraError, ValueError, KeyError, TypeError, AttributeError) as e:
+            log.warning('failed to load room and scene names', extra=avblog.kv(error=str(e)))
+
+    # Returns the devices (or scenes) that best match a spoken name, see
+    # NameResolver.resolve(). Raises VeraError if the refresh fails.
+    def resolve(self, name, kind=KIND_DEVICE):
+        self.refresh()
+        if not self.names.have_sdata:
+            self.load_sdata()
+        return self.names.resolve(name, kind)
+
+    # Called by the poller when it loses track of Vera. Lookups fall back to
+    # refreshing the snapshot once it's older than ttl.
+    def set_stale(self):
+        with self.lock:
+            self.live = False
+
+class StatusPoller(threading.Thread):
+    """
+    Background thread that keeps a StatusCache up to date using the
+    incremental status interface of Vera. After the first full request we
+    pass back the DataVersion and LoadTime Vera gave us. Vera holds the
+    request open (up to timeout seconds) until something changes and then only
+    returns the devices that changed since that DataVersion. If Vera restarted
+    (LoadTime changed) it sends the full document again.
+
+    While the poller is running "get" actions are answered from memory without
+    talking to Vera at all.
+    """
+    def __init__(self, vera, cache, timeout, min_delay):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.vera = vera
+        self.cache = cache
+        self.timeout = timeout
+        self.min_delay = min_delay
+        self.retry_delay = 5.0
+        self.data_version = None
+        self.load_time = None
+
+    def run(self):
+        while True:
+            params = {'id':'status', 'output_format':'json'}
+            if self.data_version is not None:
+                params['DataVersion'] = self.data_version
+                params['LoadTime'] = self.load_time
+                params['Timeout'] = int(self.timeout)
+                params['MinimumDelay'] = int(self.min_delay * 1000)
+
+            # Vera holds the request for up to timeout seconds so give the
+            # HTTP request a little longer than that before giving up
+            try:
+                status = self.vera.request(params, read_timeout=self.timeout + 10,
+                                           limit=False).json()
+                full = self.data_version is None or status.get('LoadTime') != self.load_time
+                self.cache.merge(status, full)
+            except (ValueError, VeraError) as e:
+                log.warning('status poll failed', extra=avblog.kv(error=str(e)))
+                self.backoff()
+                continue
+            except Exception:
+                # Something in the document we didn't expect. Keep polling
+                # (starting again with a full document), if the thread died
+                # the cache would be trusted as live forever.
+                log.exception('error handling status from Vera')
+                metrics.ERRORS.inc('poller')
+                self.backoff()
+                continue
+
+            self.data_version = status.get('DataVersion')
+            self.load_time = status.get('LoadTime')
+
+    # Let lookups go back to Vera and wait a while before polling again
+    def backoff(self):
+        self.cache.set_stale()
+        self.data_version = None
+        time.sleep(self.retry_delay)
+
+# Turn a Vera status document into a dict indexed by device id, where each
+# entry is a dict of state variable -> value
+def index_devices(status):
+    devices = {}
+    for dev in status.get('devices', []):
+        states = {}
+        for state in dev.get('states', []):
+            states[state['variable']] = state['value']
+        devices[dev['id']] = states
+    return devices
+
+def handle_msg(s, vera, msg, psk, cache, commands, batch_pool):
+    start = time.time()
+    if avblog.want_payload(log):
+        log.debug('got msg', extra=avblog.kv(raw=msg.dumps()))
     resp_data = None
 
-    # Create the message to send the response
+    # Create the message to send the response. It uses the same version,
+    # encoding and body format as the request and (for version 2+) carries the same request
+    # id. If we can't produce the body format (msgpack isn't installed) we
+    # answer in JSON, the client reads the format from the response header.
+    fmt = msg.fmt
+    if fmt not in AVBMessage.FORMATS:
+        fmt = AVBMessage.FMT_JSON
+    # A plain message to a server with a PSK is rejected, in our own
+    # encoding. (An encrypted one to a server without a PSK fails to decode
+    # below.)
+    encoding = msg.encoding
+    if psk is not None and encoding == AVBMessage.ENC_PLAIN:
+        encoding = AVBMessage.ENC_AES_CBC
     if psk is not None:
-        resp = AVBMessage(encoding=AVBMessage.ENC_AES_CBC, psk=psk)
+        resp = AVBMessage(version=msg.version, encoding=encoding, psk=psk, fmt=fmt)
     else:
-        resp = AVBMessage()
+        resp = AVBMessage(version=msg.version, fmt=fmt)
+    if msg.has_id():
+        resp.set_id(msg.get_id())
+
+    # A body format we can't read (msgpack isn't installed). The response is
+    # in JSON and lists the formats we can read, so the client can send the
+    # message again in one of them.
+    if msg.fmt not in AVBMessage.FORMATS:
+        log.warning('unsupported body format', extra=avblog.kv(fmt=msg.fmt))
+        resp_data = {'status': 1, 'err_str': FORMAT_ERROR,
+                     'data': {'formats': list(AVBMessage.FORMATS)}}
+        resp.set_data(resp_data)
+        s.sendall(resp.dumps())
+        record_msg(msg, 'invalid', resp_data, start, time.time())
+        return True
 
     # Parse the received message.
-    data = msg.get_data()
+    try:
+        if encoding != msg.encoding:
+            raise ValueError('message is not encrypted')
+        data = msg.get_data()
+    except ValueError as e:
+        log.warning('error decoding message', extra=avblog.kv(error=str(e)))
+        data = None
+    decoded = time.time()
     if data == None:
-        print 'Failed to decode message!'
         resp_data = {'status': 1, 'err_str': 'bad message format', 'data': None}
         resp.set_data(resp_data)
         s.sendall(resp.dumps())
+        record_msg(msg, 'invalid', resp_data, start, decoded)
         return False
 
+    # If the client is tracing the request, time the steps of handling it and
+    # send the spans back with the response
+    trace = None
+    if isinstance(data, dict) and isinstance(data.get('trace'), dict):
+        # The id only goes back to the client and into the logs. If it isn't
+        # a string we make one up, and anything that isn't ASCII is replaced.
+        trace_id = data['trace'].get('id')
+        if isinstance(trace_id, str):
+            trace_id = trace_id.decode('ascii', 'replace')
+        if isinstance(trace_id, unicode):
+            trace_id = trace_id.encode('ascii', 'replace')[:32]
+        else:
+            trace_id = None
+        trace = avbtrace.Trace(trace_id, start)
+        trace.add('decode', start, decoded)
+        avbtrace.activate(trace)
+
+    # The message is either a single action or a batch of them
+    try:
+        with avbtrace.span('action'):
+            if 'batch' in data:
+                action = 'batch'
+                (resp_data, ok) = run_batch(vera, cache, commands, data['batch'], batch_pool)
+            else:
+                action = action_type(data)
+                (resp_data, ok) = run_action(vera, cache, commands, data)
+    finally:
+        if trace is not None:
+            avbtrace.activate(None)
+    if trace is not None:
+        resp_data['trace'] = trace.to_dict()
+
+    # Send the response
+    resp.set_data(resp_data)
+    raw = resp.dumps()
+    if avblog.want_payload(log):
+        log.debug('sending', extra=avblog.kv(raw=raw))
+    s.sendall(raw)
+    record_msg(msg, action, resp_data, start, decoded)
+    return ok
+
+# The action type of a message body, for the metrics. Anything we don't
+# support is counted as "invalid" so clients can't create new labels.
+def action_type(data):
+    try:
+        action = data['action']['type']
+    except (KeyError, TypeError):
+        return 'invalid'
+    if action not in ('get', 'set', 'run', 'resolve'):
+        return 'invalid'
+    return action
+
+# Update the metrics and log the timings for a message handled since start
+# (and decoded at decoded)
+def record_msg(msg, action, resp_data, start, decoded):
+    end = time.time()
+    metrics.REQUESTS.inc(action)
+    metrics.RESPONSES.inc(resp_data['status'])
+    metrics.REQUEST_SECONDS.observe(end - start, action)
+    metrics.DECODE_SECONDS.observe(decoded - start)
+
+    fields = {'action': action,
+              'status': resp_data['status'],
+              'version': msg.version,
+              'bytes': msg.len(),
+              'decode_ms': (decoded - start) * 1000,
+              'ms': (end - start) * 1000}
+    if msg.has_id():
+        fields['msg_id'] = msg.get_id()
+    if resp_data['err_str'] is not None:
+        fields['err'] = resp_data['err_str']
+    if 'trace' in resp_data:
+        fields['trace'] = resp_data['trace']['id']
+    log.info('handled message', extra={'fields': fields})
+
+# Carry out a single action (the JSON body of a message) and return the tuple
+# (response data, ok). ok is False if the connection should be closed.
+def run_action(vera, cache, commands, data):
     # Turn message into appropriate Vera action
     # Currently, we support 3 types of actions (get/set/run). Get/set apply to
-    # devices while run appies to scenes
-    obj_id = data['id']
-    action = data['action']['type']
+    # devices while run appies to scenes. Resolve only looks up a name.
+    try:
+        action = data['action']['type']
+        obj_id = data.get('id')
+        name = data.get('name')
+    except (KeyError, TypeError, AttributeError):
+        obj_id = name = None
+    if (obj_id is None and name is None) or (action == 'resolve' and name is None):
+        log.warning('message has no id or action type')
+        return ({'status': 1, 'err_str': 'bad message format', 'data': None}, False)
+
+    if action == 'resolve':
+        kind = data['action'].get('kind', KIND_DEVICE)
+    elif action == 'run':
+        kind = KIND_SCENE
+    else:
+        kind = KIND_DEVICE
+    if action not in ('get', 'set', 'run', 'resolve') or kind not in (KIND_DEVICE, KIND_SCENE):
+        log.warning('invalid action', extra=avblog.kv(action=action))
+        return ({'status': 1, 'err_str': 'invalid action', 'data': None}, False)
+
+    # "set" needs the power to set the device to (0 or 1)
+    if action == 'set':
+        try:
+            power = data['action']['attribute']['power']
+        except (KeyError, TypeError):
+            power = None
+        if type(power) != int or power not in (0, 1):
+            log.warning('invalid set attribute')
+            return ({'status': 1, 'err_str': 'bad message format', 'data': None}, False)
+
+    # The id is used as a key, it has to be a number or a string
+    if obj_id is not None and not isinstance(obj_id, (int, long, basestring)):
+        log.warning('invalid id')
+        return ({'status': 1, 'err_str': 'bad message format', 'data': None}, False)
+
+    # A name that is going to be looked up has to be a string
+    if (obj_id is None or action == 'resolve') and not isinstance(name, basestring):
+        log.warning('invalid name')
+        return ({'status': 1, 'err_str': 'bad message format', 'data': None}, False)
+
+    if vera is None:
+        # Send the simulated response (echo received data back)
+        return ({'status': 2, 'err_str': 'vera simulation', 'data': data}, True)
+
+    # The id is used if the client sent one, otherwise the name is looked up
+    resolved = None
+    if obj_id is None or action == 'resolve':
+        try:
+            with avbtrace.span('resolve'):
+                matches = cache.resolve(name, kind)
+        except VeraError as e:
+            return ({'status': 2, 'err_str': str(e), 'data': None}, False)
+
+        if not matches:
+            return ({'status': 1, 'err_str': 'unknown name', 'data': []}, True)
+        if action == 'resolve':
+            return ({'status': 0, 'err_str': None, 'data': matches}, True)
+        # Rather than guess between equally good matches let the client ask
+        # the user which one they meant
+        if len(matches) > 1 and matches[1]['score'] == matches[0]['score']:
+            return ({'status': 1, 'err_str': 'ambiguous name', 'data': matches}, True)
+        obj_id = matches[0]['id']
+        resolved = {'id': obj_id, 'name': matches[0]['name']}
+
     if action == 'run':
         vera_params = {'id':'lu_action', 'output_format':'json',
                        'SceneNum':str(obj_id),
@@ -88,135 +733,307 @@ def handle_msg(s, vera_ip, vera_port, msg, psk):
                        'DeviceNum':str(obj_id),
                        'serviceId':'urn:upnp-org:serviceId:SwitchPower1',
                        'action':'SetTarget',
-                       'newTargetValue': str(data['action']['attribute']['power'])
+                       'newTargetValue': str(power)
                       }
-    elif action == 'get':
-        vera_params = {'id':'status'}
+    else:
+        vera_params = None
+
+    if action == 'get':
+        # Device state comes from the status cache, which only goes to Vera
+        # when its snapshot is stale
+        try:
+            with avbtrace.span('status'):
+                states = cache.get_device(obj_id)
+        except VeraError as e:
+            return ({'status': 2, 'err_str': str(e), 'data': None}, False)
+
+        verastate = 'unknown'
+        veraname = 'unknown'
+        if states is not None:
+            verastate = states.get('Status', verastate)
+            veraname = states.get('ConfiguredName', veraname)
+        resp = {'status':verastate, 'name':veraname}
+        if cache.is_pending(obj_id, 'Status'):
+            resp['pending'] = True
+        if resolved is not None:
+            resp['id'] = obj_id
+        return ({'status': 0, 'err_str': None, 'data': resp}, True)
+
+    # Send the appropriate HTTP request to Vera
+    log.debug('sending to Vera', extra=avblog.kv(dest=vera.dest, params=vera_params))
 
+    value = vera_params.get('newTargetValue')
+    try:
+        commands.run(action, obj_id, value, lambda: vera.request(vera_params))
+    except VeraError as e:
+        return ({'status': 2, 'err_str': str(e), 'data': None}, False)
+
+    if action == 'set':
+        # Answer a "get" that follows with the value we just set, rather than
+        # asking Vera before it has caught up
+        cache.write(obj_id, 'Status', vera_params['newTargetValue'])
     else:
-        print 'invalid action'
-        resp_data = {'status': 1, 'err_str': 'invalid action', 'data': None}
-        resp.set_data(resp_data)
-        s.sendall(resp.dumps())
-        return False
+        # There's no telling which devices the scene changed, the next "get"
+        # has to go back to Vera
+        cache.invalidate()
+    # Tell the client which device the name turned into
+    return ({'status': 0, 'err_str': None, 'data': resolved}, True)
 
-    if vera_ip is not None:
-        # Send the appropriate HTTP request to Vera
-        dest = 'http://' + vera_ip + ':' + vera_port + '/data_request'
-        print
-        print 'sending to: ' + dest
-        print 'params: ' + str(vera_params)
-        print
+# Carry out a batch of actions and return the tuple (response data, ok). The
+# actions are run in parallel on batch_pool. Vera has no way to take several
+# actions in one request, but the "get" actions all share one status snapshot
+# so at most one status request goes to Vera for the whole batch.
+def run_batch(vera, cache, commands, batch, batch_pool):
+    if type(batch) != list or len(batch) == 0 or len(batch) > MAX_BATCH_SIZE:
+        log.warning('invalid batch')
+        return ({'status': 1, 'err_str': 'invalid batch', 'data': None}, False)
 
+    # The actions run on other threads, which have to join the trace (if the
+    # client is tracing the request)
+    trace = avbtrace.current()
+    def run(data):
+        avbtrace.activate(trace)
         try:
-            r = requests.get(dest, params=vera_params)
-        except requests.exceptions.RequestException as e:
-            print e
-            resp_data = {'status': 2, 'err_str': 'requests exception', 'data': None}
-            resp.set_data(resp_data)
-            s.sendall(resp.dumps())
-            return False
+            return run_action(vera, cache, commands, data)[0]
+        finally:
+            avbtrace.activate(None)
 
-        if r.status_code != 200:
-            print 'Non-200 response from Vera'
-            print 'Code: ' + str(r.status_code)
-            resp_data = {'status': 2, 'err_str': 'bad response from Vera', 'data': None}
-            resp.set_data(resp_data)
-            s.sendall(resp.dumps())
+    results = batch_pool.map(run, batch)
+
+    # The batch succeeds only if every action did. Status 2 is only a success
+    # in simulation mode, otherwise it means Vera failed.
+    ok = (0,)
+    if vera is None:
+        ok = (0, 2)
+    failed = len([r for r in results if r['status'] not in ok])
+    if failed > 0:
+        err_str = str(failed) + ' of ' + str(len(results)) + ' actions failed'
+        return ({'status': 1, 'err_str': err_str, 'data': results}, True)
+    if vera is None:
+        return ({'status': 2, 'err_str': 'vera simulation', 'data': results}, True)
+    return ({'status': 0, 'err_str': None, 'data': results}, True)
+
+class WorkerPool:
+    """
+    Fixed number of threads that serve client connections for the threaded
+    engine. Accepted connections wait in a queue of at most queue_size entries
+    until a worker is free. When the queue is full the connection is turned
+    away instead of starting another thread.
+    """
+    def __init__(self, workers, queue_size, target):
+        self.target = target
+        self.queue = Queue.Queue(queue_size)
+        for i in range(workers):
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            t.start()
+
+    # Queue a job to be handled by target(*args). Returns False if the queue
+    # is full, unless block is set in which case we wait for space.
+    def submit(self, args, block=False):
+        try:
+            self.queue.put(args, block)
+        except Queue.Full:
             return False
-                        
-        # Get the returned JSON from Vera (only for 'get' action)
-        if action == 'get':
-            status = r.json()
-
-            verastate = 'unknown'
-            veraname = 'unknown'
-            for dev in status['devices']:
-                if dev['id'] == obj_id:
-                    for state in dev['states']:
-                        if state['variable'] == 'Status':
-                            verastate = state['value']
-                        if state['variable'] == 'ConfiguredName':
-                            veraname = state['value']
-            resp_data = {'status': 0, 'err_str': None, 'data': {'status':verastate, 'name':veraname}}
-        else:
-            resp_data = {'status': 0, 'err_str': None, 'data': None}
+        return True
 
-        # Send the response
-        resp.set_data(resp_data)
-        print 'sending: ' + resp.dumps()
-        s.sendall(resp.dumps())
-    else:
-        # Send the simulated response (echo received data back)
-        resp_data = {'status': 2, 'err_str': 'vera simulation', 'data': data}
-        resp.set_data(resp_data)
-        print 'sending: ' + resp.dumps()
-        s.sendall(resp.dumps())
+    def worker(self):
+        while True:
+            args = self.queue.get()
+            try:
+                self.target(*args)
+            except Exception as e:
+                log.warning('error in client thread', extra=avblog.kv(error=str(e)))
+
+# Complete the TLS handshake on a socket that was wrapped with
+# do_handshake_on_connect=False. Returns False (and closes the socket) if the
+# handshake fails or doesn't finish within timeout seconds. Plain sockets are
+# left alone.
+def finish_handshake(s, timeout):
+    if not isinstance(s, ssl.SSLSocket):
+        return True
 
+    s.settimeout(timeout)
+    start = time.time()
+    try:
+        s.do_handshake()
+    except (socket.timeout, socket.error) as e:
+        log.warning('handshake error', extra=avblog.kv(error=str(e)))
+        metrics.ERRORS.inc('handshake')
+        s.close()
+        return False
+    metrics.HANDSHAKE_SECONDS.observe(time.time() - start)
+    log.info('handshake done', extra=avblog.kv(
+        ms=(time.time() - start) * 1000,
+        sessions_resumed=s.context.session_stats()['hits']))
     return True
 
-# Entry point for new thread to handle specific client connection
-def client_thread(secure_s, ip, port, psk):
+# Tell a client we can't serve it right now and close the connection. This
+# runs on a single thread of its own, so the handshake uses a short timeout.
+def send_busy(s, psk):
+    if not finish_handshake(s, 1.0):
+        return
+
     if psk is not None:
-        m = AVBMessage(encoding=AVBMessage.ENC_AES_CBC, psk=psk)
+        resp = AVBMessage(encoding=AVBMessage.ENC_AES_CBC, psk=psk)
     else:
-        m = AVBMessage()
+        resp = AVBMessage()
+    resp.set_data({'status': 3, 'err_str': 'server busy', 'data': None})
+
+    try:
+        s.sendall(resp.dumps())
+        s.shutdown(socket.SHUT_RDWR)
+    except socket.error as e:
+        log.warning('send error', extra=avblog.kv(error=str(e)))
+    s.close()
+
+class LockedWriter:
+    """
+    Wraps a client socket so that responses to pipelined (version 2) requests,
+    which are sent from several dispatcher threads, don't get interleaved.
+    It also counts the pipelined requests that haven't been answered yet, the
+    connection isn't idle while there are any.
+    """
+    def __init__(self, s):
+        self.s = s
+        self.lock = threading.Lock()
+        # Separate lock so the count isn't held up by a slow sendall()
+        self.count_lock = threading.Lock()
+        self.in_flight = 0
+
+    # Called when a request is handed to the dispatcher (add=1) and when it
+    # has been handled (add=-1)
+    def track(self, add):
+        with self.count_lock:
+            self.in_flight += add
+
+    def busy(self):
+        with self.count_lock:
+            return self.in_flight > 0
+
+    def sendall(self, data):
+        with self.lock:
+            self.s.sendall(data)
+
+    # Close down the connection (e.g. after a bad message). The thread
+    # reading from the socket notices and cleans up.
+    def shutdown(self):
+        try:
+            self.s.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+# Call handler(w, m), treating an exception as a failure (the connection is
+# closed) so the client finds out straight away rather than waiting for a
+# response that never comes
+def call_handler(handler, w, m):
+    try:
+        return handler(w, m)
+    except Exception:
+        log.exception('error handling message')
+        metrics.ERRORS.inc('handler')
+        return False
+
+# Entry point for the dispatcher threads that handle pipelined requests
+def pipelined_job(w, m, handler):
+    try:
+        if not call_handler(handler, w, m):
+            log.info('error handling message, server closing connection')
+            w.shutdown()
+    finally:
+        w.track(-1)
+
+# True if e is a receive timeout. Python 2.7 reports one on a TLS socket as
+# an SSLError rather than socket.timeout.
+def is_timeout(e):
+    return isinstance(e, socket.timeout) or 'timed out' in str(e)
+
+# Shut down and close a client socket, ignoring errors (it may already be
+# closed)
+def close_client(s):
+    try:
+        s.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
+    s.close()
+
+# Entry point for new thread to handle specific client connection
+# Messages are passed to handler(s, msg). Version 1 messages are handled one at
+# a time on this thread. Version 2 messages are handed to the dispatcher pool
+# so several can be in progress at once and the responses (tagged with the
+# request id) go back in whatever order they finish.
+def client_thread(secure_s, psk, handler, dispatcher, handshake_timeout, idle_timeout):
+    metrics.CONNECTIONS.inc()
+    try:
+        serve_client(secure_s, psk, handler, dispatcher, handshake_timeout, idle_timeout)
+    finally:
+        # Whatever happened the connection is finished with
+        close_client(secure_s)
+        metrics.CONNECTIONS.dec()
+
+def serve_client(secure_s, psk, handler, dispatcher, handshake_timeout, idle_timeout):
+    # The TLS handshake is done here rather than on the accept thread so a
+    # slow client can't hold up other incoming connections
+    if not finish_handshake(secure_s, handshake_timeout):
+        return
+    writer = LockedWriter(secure_s)
 
     # Set the socket timeout. This will prevent a client from opening a connection
     # and just sitting there, consuming resources. If no message is received within
     # the timeout then an exception is raised and the thread will terminate
-    secure_s.settimeout(5.0)
+    secure_s.settimeout(idle_timeout)
 
+    reader = AVBReader(psk)
     while True:
-        # Get a new message header
-        chunks = []
-        nb = 0
-        while nb < AVBMessage.HEADER_SIZE:
-            try:
-                chunk = secure_s.recv(AVBMessage.HEADER_SIZE - nb)
-            except (socket.timeout, ssl.SSLError) as e:
-                print 'recv error: ' + str(e)
-                # Note that we issue a shutdown() here to notify the other end
-                # that we're closing the connection. If we just close the recv()
-                # on the client will just wait forever
-                secure_s.shutdown(socket.SHUT_RDWR)
-                secure_s.close()
-                return
-
-            if chunk == '':
-                print 'connection broken or closed by client'
-                secure_s.close()
-                return
-            chunks.append(chunk)
-            nb += len(chunk)
-        msg = ''.join(chunks)
-
-        # Get the length and wait for the rest
-        m.loads(msg)
-        while nb < m.len():
+        # Get the next message. Each message gets its own object since
+        # pipelined messages are still being handled while we read the next one
+        try:
+            m = reader.read_message(secure_s)
+        except (socket.timeout, ssl.SSLError) as e:
+            # A client waiting for pipelined requests that are still being
+            # handled (e.g. Vera is slow) isn't idle, keep reading
+            if is_timeout(e) and writer.busy():
+                continue
+            log.info('recv error', extra=avblog.kv(error=str(e)))
+            # Note that we issue a shutdown() here to notify the other end
+            # that we're closing the connection. If we just close the recv()
+            # on the client will just wait forever
+            close_client(secure_s)
+            return
+        except RuntimeError:
+            log.info('connection broken or closed by client')
+            secure_s.close()
+            return
+        except UnsupportedVersion as e:
+            # A newer client. Tell it which versions we speak so it can send
+            # the message again in one of them.
+            log.warning('unsupported protocol version', extra=avblog.kv(error=str(e)))
+            metrics.ERRORS.inc('version')
             try:
-                chunk = secure_s.recv(min(m.len() - nb, 1024))
-            except (socket.timeout, ssl.SSLError) as e:
-                print 'recv error: ' + str(e)
-                secure_s.shutdown(socket.SHUT_RDWR)
-                secure_s.close()
-                return
-
-            if chunk == '':
-                print 'connection broken or closed by client'
-                secure_s.close()
-                return
-            chunks.append(chunk)
-            nb += len(chunk)
-        msg = ''.join(chunks)
+                secure_s.sendall(version_error(psk))
+            except socket.error:
+                pass
+            close_client(secure_s)
+            return
+        except ValueError as e:
+            # If we can't parse the header close the connection so the client
+            # knows straight away rather than waiting for a response.
+            log.warning('bad message header', extra=avblog.kv(error=str(e)))
+            metrics.ERRORS.inc('header')
+            close_client(secure_s)
+            return
 
         # Handle the message
-        # Pass in IP address and port of vera (as strings). These are used to form
-        # the URL to send the request to Vera.
-        m.loads(msg)
-        if not handle_msg(secure_s, ip, str(port), m, psk):
-            print 'error handling message, server closing connection'
-            secure_s.close()
+        if m.has_id():
+            # If the dispatcher is backed up we stop reading from this client
+            # until it catches up
+            writer.track(1)
+            dispatcher.submit((writer, m, handler), block=True)
+            continue
+
+        if not call_handler(handler, writer, m):
+            log.info('error handling message, server closing connection')
+            close_client(secure_s)
             return
 
 def main():
@@ -237,26 +1054,90 @@ def main():
         print 'error reading configuration file: ' + cfg_file
         sys.exit()
 
+    # Everything after this point goes through the logger
+    try:
+        avblog.setup_from_config(cfg)
+    except ValueError as e:
+        print str(e)
+        sys.exit()
+
     # Setup the defaults
     port = 3000
+    engine = 'thread'
+    workers = 8
+    queue_size = 16
+    max_connections = event_server.MAX_CONNECTIONS
+    handshake_timeout = 5.0
+    idle_timeout = 5.0
+    metrics_port = None
     vera_port = 3480
+    status_ttl = 5.0
+    confirm_timeout = 10.0
+    debounce = 1.0
+    poll = False
+    poll_timeout = 60.0
+    poll_delay = 1.5
+    pool_size = 4
+    max_vera_calls = 4
+    connect_timeout = 3.0
+    read_timeout = 10.0
 
     # Make sure we have the required sections in the config file
     if cfg.has_section('vera'):
         if cfg.has_option('vera', 'ip'):
             vera_ip = cfg.get('vera', 'ip')
         else:
-            print 'missing Vera IP address'
+            log.error('missing Vera IP address')
             sys.exit()
 
         if cfg.has_option('vera', 'port'):
             vera_port = cfg.getint('vera', 'port')
+
+        if cfg.has_option('vera', 'status_ttl'):
+            status_ttl = cfg.getfloat('vera', 'status_ttl')
+        if cfg.has_option('vera', 'confirm_timeout'):
+            confirm_timeout = cfg.getfloat('vera', 'confirm_timeout')
+        if cfg.has_option('vera', 'debounce'):
+            debounce = cfg.getfloat('vera', 'debounce')
+
+        if cfg.has_option('vera', 'poll'):
+            poll = cfg.getboolean('vera', 'poll')
+        if cfg.has_option('vera', 'poll_timeout'):
+            poll_timeout = cfg.getfloat('vera', 'poll_timeout')
+        if cfg.has_option('vera', 'poll_delay'):
+            poll_delay = cfg.getfloat('vera', 'poll_delay')
+
+        if cfg.has_option('vera', 'pool_size'):
+            pool_size = cfg.getint('vera', 'pool_size')
+        if cfg.has_option('vera', 'max_calls'):
+            max_vera_calls = cfg.getint('vera', 'max_calls')
+        if cfg.has_option('vera', 'connect_timeout'):
+            connect_timeout = cfg.getfloat('vera', 'connect_timeout')
+        if cfg.has_option('vera', 'read_timeout'):
+            read_timeout = cfg.getfloat('vera', 'read_timeout')
     else:
-        print 'missing [vera] section in configuration file'
+        log.error('missing [vera] section in configuration file')
         sys.exit()
 
     if cfg.has_option('server', 'port'):
         port = cfg.getint('server', 'port')
+    if cfg.has_option('server', 'engine'):
+        engine = cfg.get('server', 'engine')
+        if engine not in ('thread', 'event'):
+            log.error('invalid server engine', extra=avblog.kv(engine=engine))
+            sys.exit()
+    if cfg.has_option('server', 'workers'):
+        workers = cfg.getint('server', 'workers')
+    if cfg.has_option('server', 'queue_size'):
+        queue_size = max(1, cfg.getint('server', 'queue_size'))
+    if cfg.has_option('server', 'max_connections'):
+        max_connections = max(1, cfg.getint('server', 'max_connections'))
+    if cfg.has_option('server', 'handshake_timeout'):
+        handshake_timeout = cfg.getfloat('server', 'handshake_timeout')
+    if cfg.has_option('server', 'idle_timeout'):
+        idle_timeout = cfg.getfloat('server', 'idle_timeout')
+    if cfg.has_option('server', 'metrics_port'):
+        metrics_port = cfg.getint('server', 'metrics_port')
 
     # See what security options are specified in the config file
     # Valid combinations are:
@@ -266,6 +1147,7 @@ def main():
     # Optionally, if psk is specified then we will use it to encrypt the message body
     security = 'none'
     psk = None
+    ciphers = None
     if cfg.has_section('security'):
         security = 'ssl'
         if cfg.has_option('security', 'root_ca') and cfg.has_option('security', 'cert') and cfg.has_option('security', 'key'):
@@ -274,6 +1156,9 @@ def main():
             cert = cfg.get('security', 'cert')
             key = cfg.get('security', 'key')
 
+        if cfg.has_option('security', 'ciphers'):
+            ciphers = cfg.get('security', 'ciphers')
+
         if cfg.has_option('security', 'psk'):
             try:
                 f = open(cfg.get('security', 'psk'), 'r')
@@ -281,33 +1166,34 @@ def main():
                 psk = f.read().rstrip('\n')
                 f.close()
             except IOError as e:
-                print 'I/O error({0}): {1}'.format(e.errno, e.strerror)
+                log.error('error reading PSK', extra=avblog.kv(errno=e.errno, error=e.strerror))
                 psk = None
 
-    print ('configuring server security profile as "' + security + '"')
+    log.info('configuring server security profile', extra=avblog.kv(security=security))
     if psk is not None:
-        print ('using PSK from ' + cfg.get('security', 'psk'))
+        log.info('using PSK', extra=avblog.kv(path=cfg.get('security', 'psk')))
 
     # Open up the port and listen for connections
     # Create the socket
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     
     # Bind the socket to the port
-    print 'starting server on ' + socket.gethostname() + ':' + str(port)
-    print
+    log.info('starting server', extra=avblog.kv(host=socket.gethostname(), port=port))
     # Do some error checking as binds can fail if the port is being used by
     # someone else
     try:
         s.bind(('', port))
     except socket.error as msg:
-        print 'socket bind() failed!'
-        print '(err ' + str(msg[0]) + '): ' + msg[1]
+        log.error('socket bind() failed', extra=avblog.kv(errno=msg[0], error=msg[1]))
         sys.exit()
 
-    # start listening (with max 5 connections queued)
-    s.listen(5)
+    # Start listening. Connections we aren't ready to accept (at the connection
+    # limit, out of file descriptors) wait in the backlog, so let it hold a
+    # burst of them.
+    s.listen(socket.SOMAXCONN)
 
     # Setup the SSL context based on assets provided in the config file
+    context = None
     if security == 'none':
         # No need to create an SSL context
         pass
@@ -325,29 +1211,95 @@ def main():
         context.verify_mode = ssl.CERT_REQUIRED
         context.load_cert_chain(certfile=cert, keyfile=key)
 
+    if context is not None:
+        # Optionally restrict the cipher suites. When we do, use our order of
+        # preference rather than the client's so ECDHE suites (which are much
+        # cheaper to handshake on the Pi) win.
+        if ciphers is not None:
+            context.set_ciphers(ciphers)
+            context.options |= ssl.OP_CIPHER_SERVER_PREFERENCE
+            context.set_ecdh_curve('prime256v1')
+
     # If the switch to turn off Vera communication was specified we will
-    # overwrite the vera_ip with None
+    # not create a Vera client at all
+    vera = None
     if args.no_vera:
-        print 'Vera communication disabled.'
-        vera_ip = None
+        log.info('Vera communication disabled')
+    else:
+        vera = VeraClient(vera_ip, vera_port, pool_size, max_vera_calls,
+                          connect_timeout, read_timeout)
+
+    # Cache of the Vera device status shared by all the client threads
+    cache = StatusCache(vera, status_ttl, confirm_timeout)
+
+    # Repeated "set" and "run" commands are only sent to Vera once
+    commands = CommandCoalescer(debounce)
+
+    # Threads that run the actions in batch messages. There is no point having
+    # more than the number of requests we allow to Vera at once.
+    batch_pool = ThreadPool(max_vera_calls)
+
+    # Optionally keep the cache up to date in the background
+    if poll and vera is not None:
+        log.info('polling Vera status', extra=avblog.kv(timeout=poll_timeout))
+        poller = StatusPoller(vera, cache, poll_timeout, poll_delay)
+        poller.start()
+
+    # Optionally serve the metrics for Prometheus to scrape
+    if metrics_port is not None:
+        try:
+            metrics.start_server(metrics_port)
+        except socket.error as msg:
+            log.error('metrics bind() failed', extra=avblog.kv(errno=msg[0], error=msg[1]))
+            sys.exit()
+        log.info('serving metrics', extra=avblog.kv(port=metrics_port))
+
+    # Both engines pass the messages they receive to this function. The Vera
+    # client is None if Vera communication is disabled.
+    def handler(w, m):
+        return handle_msg(w, vera, m, psk, cache, commands, batch_pool)
+
+    # The event engine multiplexes all the clients on a single thread and
+    # only uses a fixed number of worker threads to handle messages
+    if engine == 'event':
+        server = EventServer(s, context, psk, handler, workers, handshake_timeout, idle_timeout,
+                             max_connections)
+        server.serve_forever()
+
+    # Connections are served by a fixed number of worker threads. Pipelined
+    # requests are handled by a second pool of the same size.
+    pool = WorkerPool(workers, queue_size, client_thread)
+    dispatcher = WorkerPool(workers, queue_size, pipelined_job)
+    # Clients we turn away still need a TLS handshake to get the busy
+    # response. That's done on one thread of its own so it can't slow down
+    # the accept loop (or take more CPU from the clients we are serving).
+    rejecter = WorkerPool(1, BUSY_QUEUE_SIZE, send_busy)
 
     # Now that the server is listening, we can enter our main loop where we
     # wait for connections
     while True:
-        print 'waiting for connection...'
+        log.debug('waiting for connection')
         # accept() will block until a client has tried to connect
         (new_s, addr) = s.accept()
-        print 'connection from ' + addr[0] + ':' + str(addr[1])
+        log.info('connection', extra=avblog.kv(addr=addr[0], port=addr[1]))
+        metrics.CONNECTIONS_TOTAL.inc()
         
-        # Wrap the socket in our SSL context to protect communications
+        # Wrap the socket in our SSL context to protect communications. The
+        # handshake itself is left to the worker thread.
         if security == 'none':
             secure_s = new_s
         else:
-            secure_s = context.wrap_socket(new_s, server_side=True)
+            secure_s = context.wrap_socket(new_s, server_side=True,
+                                           do_handshake_on_connect=False)
+
+        # Hand the new client to the worker pool. If too many clients are
+        # already waiting, tell this one we're busy rather than queueing it.
+        if not pool.submit((secure_s, psk, handler, dispatcher, handshake_timeout, idle_timeout)):
+            log.warning('too many connections, sending busy response')
+            metrics.ERRORS.inc('busy')
+            if not rejecter.submit((secure_s, psk)):
+                # Even the busy responses are backed up, just hang up
+                close_client(secure_s)
 
-        # Kick off a thread to handle the new client
-        t = threading.Thread(target=client_thread, args=(secure_s, vera_ip, vera_port, psk,))
-        t.start()
-        
 if __name__ == '__main__':
     main()
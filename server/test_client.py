@@ -10,6 +10,7 @@ import threading
 # Note that you must have ../lambda in your PYTHONPATH variable for this
 # to work (e.g. export PYTHONPATH=../lambda)
 import client
+from avbmsg import AVBMessage
 
 # Thread to send a bunch of messages to the server
 def client_thread(i):
@@ -36,10 +37,11 @@ def send_data(data):
         print 'Error connecting to AVBServer: ' + msg
         sys.exit()
 
-    # Send the test messages and check response
+    # Send the test messages and check response. A list is sent in one go
+    # (pipelined if the client is configured for protocol version 2)
     if type(data) is list:
-        for d in data:
-            resp = client.send_vera_message(socket, d)
+        resps = client.send_vera_messages(socket, data)
+        for (d, resp) in zip(data, resps):
             assert d == resp['data']
     else:
         resp = client.send_vera_message(socket, data)
@@ -142,7 +144,8 @@ def main():
         (socket, msg) = client.open_connection_to_vera()
         try:
             # Send a super long tag to ensure resulting JSON string is too long
-            resp = client.send_vera_message(socket, { 't'*9999:1 } )
+            # (for any protocol version)
+            resp = client.send_vera_message(socket, { 't'*AVBMessage.MAX_MESSAGE_SIZE_V3:1 } )
         except ValueError as e:
             print 'Failed correctly with: ' + str(e)
         print
@@ -158,6 +161,64 @@ def main():
             t.join()
         print
 
+        # TEST: batch of actions in a single message
+        print 'Running test #9'
+        (socket, msg) = client.open_connection_to_vera()
+        data = [ { 'id':1, 'action': {'type': 'set', 'attribute': {'power': 0} } },
+                 { 'id':2, 'action': {'type': 'set', 'attribute': {'power': 0} } },
+                 { 'id':3, 'action': {'type': 'get' } } ]
+        resp = client.send_vera_batch(socket, data)
+        for (d, r) in zip(data, resp['data']):
+            assert d == r['data']
+        client.close_connection_to_vera(socket)
+        print
+
+        # TEST: large message, too long for protocol versions 1 and 2
+        if client.get_vera_connection().version == AVBMessage.VER_3:
+            print 'Running test #10'
+            (socket, msg) = client.open_connection_to_vera()
+            data = { 'id':1, 'action': {'type': 'get' }, 'pad': 'x'*100000 }
+            resp = client.send_vera_message(socket, data)
+            assert resp['data'] == data
+            client.close_connection_to_vera(socket)
+            print
+
+        # TEST: "set" without the attribute, on its own and in a batch (the
+        # rest of the batch should still be carried out)
+        print 'Running test #11'
+        (socket, msg) = client.open_connection_to_vera()
+        data = { 'id':1, 'action': {'type': 'set' } }
+        resp = client.send_vera_message(socket, data)
+        assert resp['status'] == 1 and resp['err_str'] == 'bad message format'
+        client.close_connection_to_vera(socket)
+        (socket, msg) = client.open_connection_to_vera()
+        data = [ { 'id':1, 'action': {'type': 'set' } },
+                 { 'id':2, 'action': {'type': 'set', 'attribute': {'power': 1} } } ]
+        resp = client.send_vera_batch(socket, data)
+        assert resp['status'] == 1
+        assert resp['data'][0]['err_str'] == 'bad message format'
+        assert resp['data'][1]['data'] == data[1]
+        client.close_connection_to_vera(socket)
+        print
+
+        # TEST: a name that isn't a string
+        print 'Running test #12'
+        (socket, msg) = client.open_connection_to_vera()
+        data = { 'name':42, 'action': {'type': 'resolve' } }
+        resp = client.send_vera_message(socket, data)
+        assert resp['status'] == 1 and resp['err_str'] == 'bad message format'
+        client.close_connection_to_vera(socket)
+        print
+
+        # TEST: an id that isn't a number or a string
+        print 'Running test #13'
+        (socket, msg) = client.open_connection_to_vera()
+        data = { 'id':[1], 'action': {'type': 'get' } }
+        resp = client.send_vera_message(socket, data)
+        assert resp['status'] == 1 and resp['err_str'] == 'bad message format'
+        client.close_connection_to_vera(socket)
+        print
+
     # Remove the security assets copied earlier
     os.remove('rootCA.pem')
     os.remove('client.crt')